@@ -0,0 +1,396 @@
+from randomtools.tablereader import (
+    set_seed, set_random_degree, set_global_output_filename, close_file,
+    get_global_label)
+from randomtools.utils import utilrandom as random
+from randomtools.interface import run_interface, get_outfile
+import randomtools.interface as interface
+import randomizer
+from randomizer import (
+    VERSION, CODES, collect_objects, randomize_rom, enable_plan_mode,
+    plan_spoiler)
+from romdiff import make_patch
+from romimage import flush_rom, use_mmap, enable_journal, find_overlaps
+from sourcecache import load_cached_objects, save_cached_objects
+from patchcache import set_patch_cache
+from rankarrays import use_numpy
+from metrics import timed, instrument_objects, reset, write_report
+from argparse import ArgumentParser
+from collections import Counter, namedtuple
+from contextlib import nullcontext, redirect_stdout
+from io import StringIO
+from multiprocessing import get_context
+from hashlib import md5
+from os import path, makedirs
+from shutil import rmtree, copyfile
+from subprocess import run, DEVNULL
+from sys import argv, stdout, stderr, exit, executable
+from tempfile import mkdtemp
+from time import time
+from traceback import format_exc
+import atexit
+import gc
+import json
+import os
+
+
+Job = namedtuple('Job', ['seed', 'flags', 'random_degree'])
+BASEPATH = path.dirname(path.abspath(__file__))
+# the source rom is loaded without any particular seed in mind; nothing
+# seeded is worked out until a job has set its own seed
+LOAD_JOB = Job(0, '', 0.5)
+WARM_TEMPLATE = None
+SOURCE_DATA = None
+LOADED_HASH = None
+SCRATCH_DIR = None
+
+
+def split_codes(flags):
+    codes = set([])
+    for code, options in sorted(CODES.items()):
+        for option in options:
+            if option in flags:
+                flags = flags.replace(option, '')
+                codes.add(code)
+                break
+    if not flags:
+        flags = ''.join(sorted({o.flag for o in randomizer.ALL_OBJECTS
+                                if hasattr(o, 'flag')}))
+    return flags, codes
+
+
+def read_jobs(filename, flags, random_degree):
+    jobs = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            values = line.split()
+            seed = int(values[0]) % (10**10)
+            job_flags = values[1] if len(values) > 1 else flags
+            job_degree = (float(values[2]) if len(values) > 2
+                          else random_degree)
+            jobs.append(Job(seed, job_flags, job_degree))
+    return jobs
+
+
+def output_filename(sourcefile, seed, output_dir=None):
+    base, extension = path.basename(sourcefile).rsplit('.', 1)
+    if output_dir is None:
+        output_dir = path.dirname(sourcefile)
+    return path.join(output_dir, '{0}.{1}.{2}'.format(base, seed, extension))
+
+
+def job_name(job):
+    # the seed, plus the flags and randomness for seeds that are in a batch
+    # more than once
+    key = '{0} {1}'.format(job.flags, job.random_degree).encode('utf8')
+    return '{0}.{1}'.format(job.seed, md5(key).hexdigest()[:8])
+
+
+def read_source(sourcefile):
+    with open(sourcefile, 'rb') as f:
+        data = f.read()
+    if len(data) % 0x400 == 0x200:
+        data = data[0x200:]
+    return data
+
+
+@timed('make_patch')
+def write_patch(outfile):
+    with open(outfile, 'rb') as f:
+        kind, data = make_patch(SOURCE_DATA, f.read())
+    patchfile = '%s.%s' % (outfile.rsplit('.', 1)[0], kind)
+    with open(patchfile, 'wb') as f:
+        f.write(data)
+    os.remove(outfile)
+    return patchfile
+
+
+def write_plan(outfile):
+    planfile = '%s.plan.json' % outfile.rsplit('.', 1)[0]
+    with open(planfile, 'w') as f:
+        json.dump(plan_spoiler(), f, indent=1, sort_keys=True)
+    os.remove(outfile)
+    return planfile
+
+
+def load_source(sourcefile, job=LOAD_JOB, cache_dir=None, quiet=False):
+    global SOURCE_DATA
+    SOURCE_DATA = read_source(sourcefile)
+    collect_objects()
+    instrument_objects(randomizer.ALL_OBJECTS)
+    cached = False
+    if cache_dir is not None:
+        set_patch_cache(path.join(cache_dir, 'patches'))
+        with timed('load_cached_objects'):
+            cached = load_cached_objects(cache_dir, sourcefile,
+                                         randomizer.ALL_OBJECTS)
+    # run_interface reads its arguments from argv; library callers get
+    # theirs back afterwards, and none of its progress output
+    saved_argv = list(argv)
+    argv[1:] = [sourcefile, job.flags, str(job.seed), str(job.random_degree)]
+    try:
+        with timed('run_interface'), (
+                redirect_stdout(StringIO()) if quiet else nullcontext()):
+            run_interface(randomizer.ALL_OBJECTS, snes=True, codes=CODES)
+    finally:
+        argv[:] = saved_argv
+    if cache_dir is not None and not cached:
+        save_cached_objects(cache_dir, sourcefile, randomizer.ALL_OBJECTS)
+    flush_rom()
+    close_file(get_outfile())
+    with open(get_outfile(), 'rb') as f:
+        return f.read()
+
+
+def prepare_job(job, outfile, template):
+    reset()
+    with open(outfile, 'wb') as f:
+        f.write(template)
+    interface.outfile = outfile
+    set_global_output_filename(outfile)
+    for o in randomizer.ALL_OBJECTS:
+        for obj in o.every:
+            obj.filename = outfile
+
+    flags, codes = split_codes(job.flags)
+    interface.flags = flags
+    interface.activated_codes = codes
+    set_random_degree(job.random_degree ** 2)
+    set_seed(job.seed)
+    random.seed(job.seed)
+
+
+def run_job(job, outfile, template):
+    prepare_job(job, outfile, template)
+    with timed('randomize_rom'):
+        randomize_rom()
+    # the header and checksum go through randomtools' own file handle
+    close_file(get_outfile())
+
+
+def job_report(filename, job, **kwargs):
+    write_report(filename, seed=job.seed, flags=job.flags,
+                 randomness=job.random_degree, version=VERSION,
+                 label=get_global_label(), **kwargs)
+
+
+def pool_job(args):
+    job, outfile, mode, metrics_file = args
+    try:
+        if mode == 'plan':
+            enable_plan_mode()
+        run_job(job, outfile, WARM_TEMPLATE)
+        for (start, end), origins in find_overlaps():
+            print('WARNING: seed %s: %s both write %x-%x' % (
+                job.seed, ' and '.join(origins), start, end-1))
+        if mode == 'plan':
+            outfile = write_plan(outfile)
+        elif mode == 'patch':
+            outfile = write_patch(outfile)
+        if metrics_file:
+            job_report(metrics_file, job, stage='seed',
+                       space=randomizer.ROM_SPACE.report())
+        return outfile
+    except Exception:
+        print('ERROR: seed %s\n%s' % (job.seed, format_exc()))
+        return None
+    finally:
+        stdout.flush()
+
+
+def generate_batch(sourcefile, jobs, output_dir=None, workers=1,
+                   mode='rom', metrics_file=None, cache_dir=None):
+    global WARM_TEMPLATE
+    if not hasattr(os, 'fork'):
+        raise Exception('Batch mode requires a platform with os.fork.')
+    if not jobs:
+        return []
+
+    keys = [(job.seed, job.flags, job.random_degree) for job in jobs]
+    if len(set(keys)) != len(keys):
+        raise Exception('Duplicate jobs in batch.')
+    seeds = Counter(job.seed for job in jobs)
+    outfiles = [output_filename(
+                    sourcefile, job_name(job) if seeds[job.seed] > 1
+                    else job.seed, output_dir)
+                for job in jobs]
+    if output_dir is not None and not path.exists(output_dir):
+        makedirs(output_dir)
+
+    start_time = time()
+    WARM_TEMPLATE = load_source(sourcefile, cache_dir=cache_dir)
+    if path.abspath(get_outfile()) not in map(path.abspath, outfiles):
+        os.remove(get_outfile())
+    print('Loaded source rom in %.2f seconds.' % (time() - start_time))
+    if metrics_file:
+        write_report(metrics_file, stage='load', version=VERSION,
+                     label=get_global_label())
+
+    # workers are forked from this process, one per seed, and share the
+    # loaded objects copy-on-write; freezing keeps the collector from
+    # touching (and so copying) those pages
+    gc.freeze()
+    stdout.flush()
+    pool = get_context('fork').Pool(workers, maxtasksperchild=1)
+    try:
+        tasks = [(job, outfile, mode, metrics_file)
+                 for (job, outfile) in zip(jobs, outfiles)]
+        outcomes = pool.map(pool_job, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    results = [(job, written or outfile, written is not None)
+               for (job, outfile, written) in zip(jobs, outfiles, outcomes)]
+
+    successes = len([r for r in results if r[2]])
+    print('Generated %s/%s seeds in %.2f seconds.' % (
+        successes, len(jobs), time() - start_time))
+    return results
+
+
+def verify_job(sourcefile, job, outfile):
+    # the same seed from the command line, which starts from nothing, in a
+    # directory of its own; any prompts get their defaults
+    tempdir = mkdtemp(prefix='bcg-verify-')
+    try:
+        copied = path.join(tempdir, path.basename(sourcefile))
+        copyfile(sourcefile, copied)
+        run([executable, path.join(BASEPATH, 'randomizer.py'), copied,
+             job.flags, str(job.seed), str(job.random_degree)],
+            input=b'\n' * 10, stdout=DEVNULL, stderr=DEVNULL, cwd=BASEPATH)
+        expected = output_filename(copied, job.seed)
+        if not path.exists(expected):
+            return False
+        with open(expected, 'rb') as f:
+            expected = f.read()
+        with open(outfile, 'rb') as f:
+            return f.read() == expected
+    finally:
+        rmtree(tempdir, True)
+
+
+def get_scratch_dir():
+    global SCRATCH_DIR
+    if SCRATCH_DIR is None:
+        # randomtools only reads and writes through file paths, so keep
+        # them in memory where the platform allows it
+        tmpfs = '/dev/shm' if path.isdir('/dev/shm') else None
+        SCRATCH_DIR = mkdtemp(prefix='bcg-', dir=tmpfs)
+        atexit.register(rmtree, SCRATCH_DIR, True)
+    return SCRATCH_DIR
+
+
+def generate(rom_bytes, seed, flags='', codes=None, random_degree=0.5,
+             patch=False):
+    global WARM_TEMPLATE, LOADED_HASH
+    job = Job(int(seed) % (10**10), flags + ''.join(codes or []),
+              random_degree)
+    rom_hash = md5(rom_bytes).hexdigest()
+    if LOADED_HASH is None:
+        sourcefile = path.join(get_scratch_dir(), 'source.smc')
+        with open(sourcefile, 'wb') as f:
+            f.write(rom_bytes)
+        WARM_TEMPLATE = load_source(sourcefile, quiet=True)
+        os.remove(get_outfile())
+        LOADED_HASH = rom_hash
+    elif rom_hash != LOADED_HASH:
+        raise Exception('Only one source rom can be loaded per process.')
+
+    outfile = path.join(get_scratch_dir(), 'output.%s.smc' % job.seed)
+    r, w = os.pipe()
+    stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            run_job(job, outfile, WARM_TEMPLATE)
+            with open(outfile, 'rb') as f:
+                data = f.read()
+            os.remove(outfile)
+            if patch:
+                _, data = make_patch(SOURCE_DATA, data)
+            with os.fdopen(w, 'wb') as f:
+                f.write(data)
+            status = 0
+        except Exception:
+            print('ERROR: seed %s\n%s' % (job.seed, format_exc()))
+        finally:
+            stdout.flush()
+            os._exit(status)
+
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise Exception('Seed %s failed.' % job.seed)
+    return data
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Beyond Chaos Gaiden batch seed generator v%s' % VERSION)
+    parser.add_argument('sourcefile')
+    parser.add_argument('seeds', nargs='*', type=int)
+    parser.add_argument('--jobs',
+                        help='file with one "seed [flags [randomness]]" '
+                             'entry per line')
+    parser.add_argument('--flags', default='')
+    parser.add_argument('--randomness', type=float, default=0.5)
+    parser.add_argument('--output-dir')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--patch', action='store_const', dest='mode',
+                        const='patch', default='rom',
+                        help='write an IPS/BPS patch instead of a full rom')
+    parser.add_argument('--plan', action='store_const', dest='mode',
+                        const='plan',
+                        help='write a JSON spoiler of what each seed '
+                             'would change instead of a rom, skipping event '
+                             'and table writes')
+    parser.add_argument('--mmap', action='store_true',
+                        help='edit output roms through a memory map')
+    parser.add_argument('--journal', action='store_true',
+                        help='warn when two parts of the randomizer write '
+                             'the same bytes')
+    parser.add_argument('--cache',
+                        help='directory to keep decoded source roms in, so '
+                             'later runs can skip decoding')
+    parser.add_argument('--metrics',
+                        help='append per-phase timings to this file as JSON')
+    parser.add_argument('--verify', action='store_true',
+                        help='check each rom against the same seed made by '
+                             'randomizer.py')
+    parser.add_argument('--numpy', action='store_true',
+                        help='rank monsters and formations with numpy, if it '
+                             'is installed')
+    args = parser.parse_args()
+
+    jobs = [Job(seed % (10**10), args.flags, args.randomness)
+            for seed in args.seeds]
+    if args.jobs:
+        jobs += read_jobs(args.jobs, args.flags, args.randomness)
+    if not jobs:
+        parser.error('no seeds given')
+
+    if args.mmap:
+        use_mmap()
+    if args.numpy:
+        use_numpy()
+    if args.journal:
+        enable_journal()
+    results = generate_batch(args.sourcefile, jobs, args.output_dir,
+                             workers=args.workers, mode=args.mode,
+                             metrics_file=args.metrics, cache_dir=args.cache)
+    for job, outfile, result in results:
+        if not result:
+            stderr.write('FAILED: seed %s\n' % job.seed)
+    if args.verify and args.mode == 'rom':
+        for i, (job, outfile, result) in enumerate(results):
+            if result and not verify_job(args.sourcefile, job, outfile):
+                stderr.write('MISMATCH: seed %s\n' % job.seed)
+                results[i] = (job, outfile, False)
+    if not all(result for (_, _, result) in results):
+        exit(1)
@@ -0,0 +1,169 @@
+from randomizer import VERSION
+from argparse import ArgumentParser
+from collections import defaultdict
+from os import path
+from shutil import rmtree
+from subprocess import call
+from sys import executable, exit
+from tempfile import mkdtemp
+import json
+
+
+SEEDS = [1001, 1002, 1003]
+FLAG_SETS = ['acegmpqrt', 'vfanatix', 'u', 'kl']
+BASEPATH = path.dirname(path.abspath(__file__))
+RANK_PHASE = 'seed:randomize_rom'
+
+
+def master_labels():
+    labels = []
+    with open(path.join(BASEPATH, 'tables', 'master.txt')) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                label, md5, _ = line.split()
+                if md5 != 'NONE':
+                    labels.append(label)
+    return labels
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1] + values[middle]) / 2.0
+
+
+def run_case(sourcefile, flags, seeds, options=None):
+    tempdir = mkdtemp()
+    try:
+        metrics_file = path.join(tempdir, 'metrics.jsonl')
+        command = [executable, path.join(BASEPATH, 'batch.py'), sourcefile]
+        command += [str(seed) for seed in seeds]
+        command += ['--flags', flags, '--output-dir', tempdir,
+                    '--metrics', metrics_file]
+        command += options or []
+        if call(command, cwd=BASEPATH) != 0:
+            raise Exception('Benchmark failed: %s %s' % (sourcefile, flags))
+        with open(metrics_file) as f:
+            return [json.loads(line) for line in f]
+    finally:
+        rmtree(tempdir)
+
+
+def summarize(records):
+    phases = defaultdict(lambda: defaultdict(list))
+    for record in records:
+        # phases that run more than once per seed are added together
+        totals = defaultdict(lambda: defaultdict(float))
+        for timing in record['phases']:
+            phase = '{0}:{1}'.format(record['stage'], timing['phase'])
+            totals[phase]['wall'] += timing['wall']
+            totals[phase]['cpu'] += timing['cpu']
+            totals[phase]['maxrss'] = max(totals[phase]['maxrss'],
+                                          timing['maxrss'] or 0)
+        for phase, values in totals.items():
+            for key, value in values.items():
+                phases[phase][key].append(value)
+
+    summary = {}
+    for phase, values in phases.items():
+        summary[phase] = {'wall': median(values['wall']),
+                          'cpu': median(values['cpu']),
+                          'maxrss': max(values['maxrss'])}
+    return summary
+
+
+def run_benchmark(sourcefiles, flag_sets=FLAG_SETS, seeds=SEEDS):
+    results = {}
+    for sourcefile in sourcefiles:
+        for flags in flag_sets:
+            records = run_case(sourcefile, flags, seeds)
+            case = '{0} {1}'.format(records[0]['label'], flags)
+            print('Finished %s' % case)
+            results[case] = summarize(records)
+    return {'version': VERSION, 'seeds': seeds, 'results': results}
+
+
+def numpy_speedup(sourcefiles, flags, seeds, phase=RANK_PHASE):
+    speedups = {}
+    for sourcefile in sourcefiles:
+        records = run_case(sourcefile, flags, seeds)
+        without_numpy = summarize(records)
+        with_numpy = summarize(run_case(sourcefile, flags, seeds,
+                                        ['--numpy']))
+        speedups[records[0]['label']] = (without_numpy[phase]['wall'],
+                                         with_numpy[phase]['wall'])
+    return speedups
+
+
+def compare(results, baseline, time_threshold, memory_threshold, min_time):
+    regressions = []
+    for case, phases in sorted(results['results'].items()):
+        if case not in baseline['results']:
+            continue
+        for phase, values in sorted(phases.items()):
+            if phase not in baseline['results'][case]:
+                continue
+            old = baseline['results'][case][phase]
+            for key, threshold in [('wall', time_threshold),
+                                   ('cpu', time_threshold),
+                                   ('maxrss', memory_threshold)]:
+                if key != 'maxrss' and max(values[key], old[key]) < min_time:
+                    continue
+                if not old[key]:
+                    continue
+                change = (values[key] - old[key]) / float(old[key])
+                if change > threshold:
+                    regressions.append((case, phase, key, old[key],
+                                        values[key], change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Beyond Chaos Gaiden benchmark v%s' % VERSION)
+    parser.add_argument('sourcefiles', nargs='+',
+                        help='one source rom for each version to measure')
+    parser.add_argument('--flags', nargs='+', default=FLAG_SETS)
+    parser.add_argument('--seeds', nargs='+', type=int, default=SEEDS)
+    parser.add_argument('--output', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare against saved results')
+    parser.add_argument('--time-threshold', type=float, default=0.2)
+    parser.add_argument('--memory-threshold', type=float, default=0.1)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='ignore time changes in phases shorter than '
+                             'this many seconds')
+    parser.add_argument('--numpy-speedup', action='store_true',
+                        help='only time seeds with and without numpy')
+    args = parser.parse_args()
+
+    if args.numpy_speedup:
+        speedups = numpy_speedup(args.sourcefiles, args.flags[0], args.seeds)
+        for label, (old, new) in sorted(speedups.items()):
+            print('%s seeds: %.3fs without numpy, %.3fs with (%.1fx)' % (
+                label, old, new, old / new if new else 0))
+        exit(0)
+
+    results = run_benchmark(args.sourcefiles, args.flags, args.seeds)
+    labels = {case.split()[0] for case in results['results']}
+    for label in master_labels():
+        if label not in labels:
+            print('No source rom given for %s.' % label)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_threshold,
+                              args.memory_threshold, args.min_time)
+        for case, phase, key, old, new, change in regressions:
+            print('REGRESSION: %s %s %s %.3f -> %.3f (%+.0f%%)' % (
+                case, phase, key, old, new, change * 100))
+        if regressions:
+            exit(1)
+        print('No regressions against %s.' % args.baseline)
@@ -0,0 +1,168 @@
+from randomtools.interface import get_outfile
+from batch import Job, load_source, output_filename, run_job
+from benchmark import SEEDS, FLAG_SETS
+from metrics import LISTENERS
+import randomizer
+from randomizer import VERSION
+from argparse import ArgumentParser
+from hashlib import md5
+from multiprocessing import get_context
+from io import StringIO
+from os import path
+from shutil import rmtree, copyfile
+from sys import argv, exit
+from tempfile import mkdtemp
+from traceback import format_exc
+import gc
+import json
+import os
+import sys
+
+
+CHECKPOINTS = ['randomize_all', 'mutate_all', 'full_cleanup']
+WARM_TEMPLATE = None
+SOURCEFILE = None
+
+
+def hash_class(cls):
+    values = []
+    for o in cls.every:
+        attrs = sorted(o.old_data)
+        values.append((o.index, [(a, getattr(o, a, None)) for a in attrs]))
+    return md5(repr(values).encode('utf8')).hexdigest()
+
+
+def hash_all():
+    return {cls.__name__: hash_class(cls) for cls in randomizer.ALL_OBJECTS}
+
+
+def warm_run(job, tempdir):
+    # the batch path, forked from a process that has loaded the source rom
+    outfile = output_filename(SOURCEFILE, job.seed, tempdir)
+    run_job(job, outfile, WARM_TEMPLATE)
+    return outfile
+
+
+def cold_run(job, tempdir):
+    # the command line path, from a process that has loaded nothing; any
+    # prompts get their defaults
+    sourcefile = path.join(tempdir, path.basename(SOURCEFILE))
+    copyfile(SOURCEFILE, sourcefile)
+    argv[1:] = [sourcefile, job.flags, str(job.seed), str(job.random_degree)]
+    sys.stdin = StringIO('\n' * 10)
+    randomizer.main()
+    return output_filename(sourcefile, job.seed)
+
+
+def golden_job(args):
+    job, run = args
+    hashes = []
+
+    def checkpoint(phase):
+        if '.' in phase:
+            name, method = phase.split('.', 1)
+            if method in CHECKPOINTS:
+                cls = getattr(randomizer, name)
+                hashes.append((phase, hash_class(cls)))
+        elif phase == 'execute_fanatix_mode':
+            for name, value in sorted(hash_all().items()):
+                hashes.append(('%s:%s' % (phase, name), value))
+
+    tempdir = mkdtemp()
+    try:
+        LISTENERS.append(checkpoint)
+        outfile = run(job, tempdir)
+        LISTENERS.remove(checkpoint)
+        for name, value in sorted(hash_all().items()):
+            hashes.append(('final:%s' % name, value))
+        with open(outfile, 'rb') as f:
+            hashes.append(('rom', md5(f.read()).hexdigest()))
+        return hashes
+    except Exception:
+        print('ERROR: seed %s\n%s' % (job.seed, format_exc()))
+        return None
+    finally:
+        rmtree(tempdir)
+
+
+def run_golden(sourcefile, jobs, cold=False):
+    global WARM_TEMPLATE, SOURCEFILE
+    SOURCEFILE = sourcefile
+    run = cold_run
+    if not cold:
+        WARM_TEMPLATE = load_source(sourcefile)
+        os.remove(get_outfile())
+        gc.freeze()
+        run = warm_run
+    pool = get_context('fork').Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(golden_job, [(job, run) for job in jobs],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return {'{0} {1}'.format(job.seed, job.flags): hashes
+            for (job, hashes) in zip(jobs, results)}
+
+
+def compare(results, golden):
+    failures = [(case, 'missing') for case in sorted(golden)
+                if case not in results]
+    for case, hashes in sorted(results.items()):
+        if case not in golden:
+            failures.append((case, 'not recorded'))
+            continue
+        if hashes is None:
+            failures.append((case, 'error'))
+            continue
+        expected = golden[case]
+        for (name, value), (_, old) in zip(hashes, expected):
+            if value != old:
+                # the first difference is where the output diverged
+                failures.append((case, name))
+                break
+        else:
+            if len(hashes) != len(expected):
+                failures.append((case, 'checkpoint count'))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Beyond Chaos Gaiden golden hash check v%s' % VERSION)
+    parser.add_argument('sourcefile')
+    parser.add_argument('goldenfile')
+    parser.add_argument('--flags', nargs='+', default=FLAG_SETS)
+    parser.add_argument('--seeds', nargs='+', type=int, default=SEEDS)
+    parser.add_argument('--randomness', type=float, default=0.5)
+    parser.add_argument('--record', action='store_true',
+                        help='save new golden hashes, made the way '
+                             'randomizer.py makes seeds, instead of checking')
+    parser.add_argument('--cold', action='store_true',
+                        help='check seeds made the way randomizer.py makes '
+                             'them, instead of the way batch mode does')
+    args = parser.parse_args()
+
+    jobs = [Job(seed, flags, args.randomness)
+            for flags in args.flags for seed in args.seeds]
+    results = run_golden(args.sourcefile, jobs,
+                         cold=args.record or args.cold)
+
+    if args.record:
+        if any(hashes is None for hashes in results.values()):
+            exit(1)
+        with open(args.goldenfile, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('Recorded %s cases to %s.' % (len(results), args.goldenfile))
+    else:
+        with open(args.goldenfile) as f:
+            golden = json.load(f)
+        failures = compare(results, golden)
+        for case, name in failures:
+            if name in ['missing', 'not recorded']:
+                print('MISMATCH: %s is %s' % (case, name))
+            else:
+                print('MISMATCH: %s first differs at %s' % (case, name))
+        if failures:
+            exit(1)
+        print('All %s cases match %s.' % (len(results), args.goldenfile))
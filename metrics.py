@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+from time import time, process_time
+import json
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage = None
+
+
+PHASE_METHODS = ['randomize_all', 'mutate_all', 'full_preclean',
+                 'full_cleanup']
+TIMINGS = []
+LISTENERS = []
+ACTIVE = set([])
+PEAKS = []
+
+
+def peak_rss():
+    # the high-water mark in kilobytes on linux, or bytes on mac
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    if getrusage is None:
+        return None
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    # linux can start the high-water mark over from the current size
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return True
+
+
+def note_peak():
+    # every phase still running saw the peak since the last reset
+    peak = peak_rss()
+    if peak is not None:
+        PEAKS[:] = [max(p, peak) for p in PEAKS]
+
+
+def reset():
+    del(TIMINGS[:])
+
+
+@contextmanager
+def timed(name):
+    note_peak()
+    resettable = reset_peak_rss()
+    start_rss = peak_rss()
+    PEAKS.append(start_rss)
+    start_wall, start_cpu = time(), process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time() - start_wall, process_time() - start_cpu
+        note_peak()
+        peak = PEAKS.pop()
+        if not resettable and peak == start_rss:
+            # the process's peak came before this phase
+            peak = None
+        TIMINGS.append({'phase': name,
+                        'wall': round(wall, 6),
+                        'cpu': round(cpu, 6),
+                        'maxrss': peak})
+        for listener in LISTENERS:
+            listener(name)
+
+
+def timed_classmethod(name, original):
+    def wrapper(cls, *args, **kwargs):
+        # a subclass calling up into an instrumented parent is already
+        # being timed under its own name
+        key = (cls, name)
+        if key in ACTIVE:
+            return original(cls, *args, **kwargs)
+        ACTIVE.add(key)
+        try:
+            with timed('{0}.{1}'.format(cls.__name__, name)):
+                return original(cls, *args, **kwargs)
+        finally:
+            ACTIVE.remove(key)
+    wrapper.instrumented = True
+    return classmethod(wrapper)
+
+
+def instrument_objects(objects):
+    originals = {}
+    for o in objects:
+        for name in PHASE_METHODS:
+            method = getattr(o, name)
+            if getattr(method, 'instrumented', False):
+                continue
+            originals[o, name] = method.__func__
+    for (o, name), original in originals.items():
+        setattr(o, name, timed_classmethod(name, original))
+
+
+def report(**kwargs):
+    record = dict(kwargs)
+    record['phases'] = list(TIMINGS)
+    return record
+
+
+def write_report(filename, **kwargs):
+    # one short append per record, so forked workers can share the file
+    line = json.dumps(report(**kwargs), sort_keys=True) + '\n'
+    with open(filename, 'a') as f:
+        f.write(line)
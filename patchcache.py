@@ -0,0 +1,103 @@
+from randomtools.tablereader import (
+    get_activated_patches, get_global_label, write_patch, tblpath)
+from randomtools.interface import get_outfile
+from romimage import get_rom, flush_rom, external_write, merge_ranges
+from romdiff import diff_runs
+from romspace import patch_ranges, read_validation
+from hashlib import md5
+from os import path, makedirs, replace, fdopen
+from tempfile import mkstemp
+import pickle
+
+
+# bumped whenever compile_patch changes what it keeps
+COMPILED_FORMAT = 2
+PATCH_CACHE_DIR = None
+COMPILED = {}
+APPLIED = set()
+
+
+def set_patch_cache(cache_dir):
+    global PATCH_CACHE_DIR
+    PATCH_CACHE_DIR = cache_dir
+
+
+def applied_patches():
+    return set(get_activated_patches()) | APPLIED
+
+
+def patch_key(filename):
+    h = md5('{0}.{1}'.format(COMPILED_FORMAT,
+                             get_global_label()).encode('ascii'))
+    with open(path.join(tblpath, filename), 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def load_compiled(key):
+    if key in COMPILED:
+        return COMPILED[key]
+    filename = path.join(PATCH_CACHE_DIR, '%s.pickle' % key)
+    if not path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        COMPILED[key] = pickle.loads(f.read())
+    return COMPILED[key]
+
+
+def save_compiled(key, compiled):
+    COMPILED[key] = compiled
+    if not path.exists(PATCH_CACHE_DIR):
+        makedirs(PATCH_CACHE_DIR)
+    # workers may compile the same patch at once, so each writes its own
+    # temporary file
+    fd, tempname = mkstemp(dir=PATCH_CACHE_DIR, suffix='.tmp')
+    with fdopen(fd, 'wb') as f:
+        f.write(pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL))
+    replace(tempname, path.join(PATCH_CACHE_DIR, '%s.pickle' % key))
+
+
+def compile_patch(filename):
+    # labels and the like are left to randomtools: the patch is applied the
+    # usual way once, and every byte it writes is kept as (offset, bytes)
+    # runs, including those it wrote with the values already there, along
+    # with the bytes it expects to find beforehand
+    patchfile = path.join(tblpath, filename)
+    before = bytes(get_rom().data)
+    with external_write(filename):
+        write_patch(get_outfile(), filename)
+    after = get_rom().data
+    ranges = merge_ranges(patch_ranges(patchfile)
+                          + diff_runs(before, after, 0))
+    runs = [(start, bytes(after[start:end])) for (start, end) in ranges]
+    expected = [(start, before[start:end]) for (start, end) in ranges]
+    expected += read_validation(patchfile)
+    return expected, runs
+
+
+def matches(rom, expected):
+    return all(rom.read(address, len(data)) == data
+               for (address, data) in expected)
+
+
+def apply_cached_patch(filename):
+    if PATCH_CACHE_DIR is None:
+        return False
+    if filename in APPLIED:
+        return True
+    key = patch_key(filename)
+    compiled = load_compiled(key)
+    if compiled is None:
+        save_compiled(key, compile_patch(filename))
+    else:
+        expected, runs = compiled
+        rom = get_rom()
+        if not matches(rom, expected):
+            # this rom was changed before the patch went in, so the cached
+            # runs may be incomplete
+            flush_rom()
+            return False
+        for address, data in runs:
+            rom.write(address, data, filename)
+    APPLIED.add(filename)
+    return True
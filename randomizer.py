@@ -1,17 +1,22 @@
 from randomtools.tablereader import (
     TableObject, get_global_label, addresses, gen_random_normal,
-    get_activated_patches, mutate_normal, shuffle_normal, write_patch,
-    get_random_degree, tblpath, get_open_file)
+    mutate_normal, shuffle_normal, write_patch, get_random_degree, tblpath,
+    get_open_file)
 from randomtools.utils import (
     classproperty, cached_property, utilrandom as random)
 from randomtools.interface import (
     get_outfile, get_seed, get_flags, get_activated_codes, activate_code,
     run_interface, rewrite_snes_meta, clean_and_write, finish_interface)
 from ex_utils import generate_character_palette, shuffle_char_hues
+from metrics import timed, instrument_objects, write_report
+from romimage import get_rom, flush_rom, external_write
+from patchcache import apply_cached_patch, applied_patches
+from romspace import RomSpace, patch_ranges
+import rankarrays
 from collections import Counter, defaultdict
 from time import time, gmtime
 from itertools import combinations
-from os import path
+from os import path, environ
 from traceback import format_exc
 
 
@@ -19,6 +24,10 @@ VERSION = "6.2"
 ALL_OBJECTS = None
 DEBUG_MODE = False
 FOOLS = False
+PLAN_MODE = False
+PLAN = {}
+ROM_SPACE = None
+MUSIC_FREESPACE = '410000-57FFFF'
 
 price_message_indexes = {
     10:     0xa6b,
@@ -86,6 +95,33 @@ def int_to_bytelist(value, length):
     return value_list
 
 
+def apply_patch(filename):
+    with timed('write_patch:%s' % filename):
+        if not apply_cached_patch(filename):
+            with external_write(filename):
+                write_patch(get_outfile(), filename)
+    if ROM_SPACE is not None:
+        reserve_patch(filename)
+
+
+def reserve_patch(filename):
+    for start, end in patch_ranges(path.join(tblpath, filename)):
+        ROM_SPACE.reserve(start, end, filename)
+
+
+def music_objects(cls, before, after):
+    # objects that need to be reread after music randomization: those whose
+    # record changed in the rom, or that were already changed in memory,
+    # since rereading resets them
+    size = sum(length for (_, length, _) in cls.specsattrs)
+    for o in cls.every:
+        if before[o.pointer:o.pointer+size] != after[o.pointer:o.pointer+size]:
+            yield o
+        elif any(getattr(o, attr) != value
+                 for (attr, value) in o.old_data.items()):
+            yield o
+
+
 class PaletteMixin(TableObject):
     @classmethod
     def color_to_rgb(cls, color):
@@ -365,6 +401,7 @@ class MusicObject(TableObject):
     flag = 'u'
     flag_description = 'music'
 
+    @timed('MusicObject.randomize')
     def randomize(self):
         from johnnydmad.johnnydmad import (
             BASEPATH,
@@ -376,15 +413,18 @@ class MusicObject(TableObject):
         if ('SAFE_MODE' not in get_global_label()
                 and 'BNW' not in get_global_label()
                 and 'JP' not in get_global_label()):
-            write_patch(get_outfile(), 'music_player_patch.txt')
+            apply_patch('music_player_patch.txt')
 
-        with open(get_outfile(), 'rb') as f:
-            outrom = f.read()
+        # johnnydmad also rewrites formation and map music, the music player
+        # and pointers outside its freespace, so it gets a copy of the whole
+        # rom and the whole result is written back
+        before = bytes(get_rom().data)
+        outrom = before
 
         subpath = path.join(BASEPATH, 'johnnydmad')
         metadata = {}
         playlist_filename = path.join(tblpath, 'playlist.txt')
-        freespace = ['410000-57FFFF']
+        freespace = [MUSIC_FREESPACE]
         outrom = process_music(outrom, playlist_filename=playlist_filename,
                                subpath=subpath, meta=metadata,
                                freespace=freespace)
@@ -397,18 +437,18 @@ class MusicObject(TableObject):
             outrom = process_formation_music_by_table(
                 outrom, form_music=path.join(tblpath, 'formationmusic.txt'))
         outrom = process_map_music(outrom, conditional_narshe_mines=False)
-        if 'music_player_patch.txt' in get_activated_patches():
+        if 'music_player_patch.txt' in applied_patches():
             outrom = add_music_player(outrom, metadata=metadata)
 
-        with open(get_outfile(), 'wb') as f:
-            f.write(outrom)
+        with external_write('johnnydmad'):
+            with open(get_outfile(), 'wb') as f:
+                f.write(outrom)
 
-        f = get_open_file(get_outfile())
-        f.flush()
-        for fmo in FormationMetaObject.every:
-            fmo.reload_randomized_music()
-        for l in LocationObject.every:
-            l.reload_randomized_music()
+            f = get_open_file(get_outfile())
+            f.flush()
+        for cls in [FormationMetaObject, LocationObject]:
+            for o in music_objects(cls, before, outrom):
+                o.reload_randomized_music()
 
         spoiler = get_music_spoiler()
         spoiler_filename = 'music.{0}.txt'.format(get_seed())
@@ -617,7 +657,7 @@ class NpcObject(TableObject):
         self.misc |= (membit << 22)
         assert self.membit == membit
 
-    def become_pay_save(self, pointer, price, price_message, pay_save_command,
+    def become_pay_save(self, price, price_message, pay_save_command,
                         write_event):
         self.graphics = 0x6F
         self.set_palette(6)
@@ -626,16 +666,21 @@ class NpcObject(TableObject):
             self.set_event_addr(self.done_pay_saves[price])
             return
 
-        yes_p = pointer + 13
-        no_p = yes_p + 7
-        script = [
-            0x4B] + int_to_bytelist(price_message, 2) + [   # show price
-            0x4B] + int_to_bytelist(addresses.ask_message | 0x8000, 2) + [
-            0xB6] + int_to_bytelist(yes_p, 3) + int_to_bytelist(no_p, 3) + [
-            0x85] + int_to_bytelist(price, 2)               # take money
-        script += pay_save_command + [0xFE]
-        assert script[no_p-pointer:] == [0xFE]
-        event_addr = write_event(script) - 0xA0000
+        def save_script(pointer):
+            yes_p = pointer + 13
+            no_p = yes_p + 7
+            script = [
+                0x4B] + int_to_bytelist(price_message, 2) + [   # show price
+                0x4B] + int_to_bytelist(addresses.ask_message | 0x8000,
+                                        2) + [
+                0xB6] + (int_to_bytelist(yes_p, 3) +
+                         int_to_bytelist(no_p, 3)) + [
+                0x85] + int_to_bytelist(price, 2)               # take money
+            script += pay_save_command + [0xFE]
+            assert script[no_p-pointer:] == [0xFE]
+            return script
+
+        event_addr = write_event(save_script) - 0xA0000
         self.set_event_addr(event_addr)
         self.done_pay_saves[price] = event_addr
 
@@ -856,6 +901,23 @@ class EventSpriteObject(TableObject):
 
 
 class DialoguePtrObject(TableObject):
+    @classproperty
+    def dialogue_banks(cls):
+        # the pointers are 16 bits, and move on to the next bank wherever
+        # they wrap around; the last message in a bank runs to its 0x00
+        pointers = [dpo.old_data['dialogue_pointer'] for dpo in cls.every]
+        banks = []
+        bank = 0xD0000
+        for i, pointer in enumerate(pointers):
+            if i == 0 or pointer < pointers[i-1]:
+                if i > 0:
+                    bank += 0x10000
+                banks.append([bank | pointer, bank | pointer])
+            banks[-1][1] = max(banks[-1][1], bank | pointer)
+        rom = get_rom()
+        return [(start, rom.data.find(b'\x00', end) + 1)
+                for (start, end) in banks]
+
     @classmethod
     def bring_back_auction_prices(cls):
         if 'BNW' not in get_global_label():
@@ -869,7 +931,7 @@ class DialoguePtrObject(TableObject):
         message_tail = b'\x7f\x26\x2f\x5e\x00'
         reverse_dict = dict([(v, k) for (k, v)
                              in price_message_indexes.items()])
-        f = open(get_outfile(), 'r+b')
+        rom = get_rom()
         for i in indexes:
             dpo = DialoguePtrObject.get(i)
             dpo.dialogue_pointer = pointer & 0xFFFF
@@ -877,9 +939,8 @@ class DialoguePtrObject(TableObject):
             content = b''
             for c in value:
                 content += bytes([0x54 + int(c)])
-            f.seek(pointer)
             s = message_head + content + message_tail
-            f.write(s)
+            rom.write(pointer, s, 'auction_prices')
             pointer += len(s)
 
 
@@ -1013,12 +1074,18 @@ class MonsterObject(TableObject):
         ml = MonsterLootObject.get(self.index)
         return ml.drops
 
+    @classproperty
+    def farmable_monsters(self):
+        if hasattr(self, '_farmable_monsters'):
+            return self._farmable_monsters
+        self._farmable_monsters = {m for f in FormationObject.every
+                                   if f.is_random_encounter
+                                   for m in f.old_enemies}
+        return self.farmable_monsters
+
     @cached_property
     def is_farmable(self):
-        for f in FormationObject.every:
-            if f.is_random_encounter and self in f.old_enemies:
-                return True
-        return False
+        return self in MonsterObject.farmable_monsters
 
     @property
     def rank(self):
@@ -1040,19 +1107,27 @@ class MonsterObject(TableObject):
                              len(m.ai_script), m.signature)
         score_b = lambda m: (m.true_hp_old, m.old_data['level'],
                              len(m.ai_script), m.signature)
-        by_a = sorted(monsters, key=score_a)
-        by_b = sorted(monsters, key=score_b)
+        by_a = {m: i for (i, m) in enumerate(sorted(monsters, key=score_a))}
+        by_b = {m: i for (i, m) in enumerate(sorted(monsters, key=score_b))}
 
         LEVEL_MULTIPLIER = 1.5
         HP_MULTIPLIER = 1
 
-        for m in MonsterObject.every:
-            if m in monsters:
-                a, b = (by_a.index(m) * LEVEL_MULTIPLIER,
-                        by_b.index(m) * HP_MULTIPLIER)
-                m._base_rank = max(a, b) * (a+b)
-            else:
-                m._base_rank = -1
+        if rankarrays.USE_NUMPY:
+            base_ranks = rankarrays.monster_base_ranks(
+                [by_a.get(m, -1) for m in MonsterObject.every],
+                [by_b.get(m, -1) for m in MonsterObject.every],
+                LEVEL_MULTIPLIER, HP_MULTIPLIER)
+            for m, base_rank in zip(MonsterObject.every, base_ranks):
+                m._base_rank = base_rank
+        else:
+            for m in MonsterObject.every:
+                if m in by_a:
+                    a, b = (by_a[m] * LEVEL_MULTIPLIER,
+                            by_b[m] * HP_MULTIPLIER)
+                    m._base_rank = max(a, b) * (a+b)
+                else:
+                    m._base_rank = -1
 
         companion_dict = defaultdict(set)
         for f in FormationObject.every:
@@ -1060,6 +1135,18 @@ class MonsterObject(TableObject):
             for m in enemies:
                 companion_dict[m] |= enemies
 
+        if rankarrays.USE_NUMPY:
+            monsters = MonsterObject.every
+            ranks = rankarrays.companion_ranks(
+                [m._base_rank for m in monsters],
+                [[m2.index for m2 in companion_dict[m]]
+                 if m in companion_dict else [] for m in monsters],
+                fixed=[m in companion_dict and m.is_boss for m in monsters],
+                default=-1)
+            for m, rank in zip(monsters, ranks):
+                m._rank = rank
+            return self.rank
+
         for m in MonsterObject.every:
             if m in companion_dict:
                 companion_rank = (
@@ -1295,6 +1382,10 @@ class MonsterRageObject(TableObject):
 
 
 class PackObject(TableObject):
+    WEIGHTS = {4: [5, 5, 5, 1],
+               2: [1, 1]}
+    FORMATION_ATTRIBUTES = ['common', 'common1', 'common2', 'common3', 'rare']
+
     def __repr__(self):
         s = '%s-PACK %x:\n%s' % (
             len(self.formations), self.index,
@@ -1323,27 +1414,49 @@ class PackObject(TableObject):
     def has_xp(self):
         return all([f.has_xp and f.rank >= 0 for f in self.formations])
 
+    def __setattr__(self, attribute, value):
+        # the rank only changes when the formations do
+        if (attribute in PackObject.FORMATION_ATTRIBUTES
+                and '_rank' in self.__dict__):
+            del(self._rank)
+        super(PackObject, self).__setattr__(attribute, value)
+
     @property
     def rank(self):
+        if hasattr(self, '_rank'):
+            return self._rank
+
         if any([f.rank < 0 for f in self.formations]):
-            return -1
+            self._rank = -1
+            return self.rank
 
-        if len(self.formations) == 4:
-            weights = [5, 5, 5, 1]
-        else:
-            assert len(self.formations) == 2
-            weights = [1, 1]
+        assert len(self.formations) in PackObject.WEIGHTS
+        weights = PackObject.WEIGHTS[len(self.formations)]
 
         rank = 0
         for w, f in zip(weights, self.formations):
             rank += (w / float(sum(weights))) * f.rank
 
-        return rank
+        self._rank = rank
+        return self.rank
+
+    @classmethod
+    def get_ranks(cls, packs):
+        unranked = [p for p in packs if not hasattr(p, '_rank')]
+        if rankarrays.USE_NUMPY and unranked:
+            formations = [p.formations for p in unranked]
+            assert all(len(fs) in PackObject.WEIGHTS for fs in formations)
+            ranks = rankarrays.pack_ranks(
+                [[f.rank for f in fs] for fs in formations],
+                [PackObject.WEIGHTS[len(fs)] for fs in formations])
+            for p, rank in zip(unranked, ranks):
+                p._rank = rank
+        return [p.rank for p in packs]
 
     @property
     def formation_ids(self):
         formation_ids = []
-        for attr in ['common', 'common1', 'common2', 'common3', 'rare']:
+        for attr in PackObject.FORMATION_ATTRIBUTES:
             if hasattr(self, attr):
                 formation_ids.append(getattr(self, attr))
         assert len(formation_ids) in [2, 4]
@@ -1357,7 +1470,7 @@ class PackObject(TableObject):
     @cached_property
     def old_formation_ids(self):
         formation_ids = []
-        for attr in ['common', 'common1', 'common2', 'common3', 'rare']:
+        for attr in PackObject.FORMATION_ATTRIBUTES:
             if hasattr(self, attr):
                 formation_ids.append(self.old_data[attr])
         assert len(formation_ids) in [2, 4]
@@ -1579,13 +1692,22 @@ class FormationObject(TableObject):
         if hasattr(self, '_rank'):
             return self._rank
 
-        for f in FormationObject.every:
-            enemy_ranks = [e.rank for e in f.enemies if e.rank > 0]
-            if not enemy_ranks:
-                f._base_rank = -1
-            else:
-                f._base_rank = max(enemy_ranks) * (sum(enemy_ranks)**0.0625)
-            f._rank = f._base_rank
+        if rankarrays.USE_NUMPY:
+            base_ranks = rankarrays.formation_base_ranks(
+                [[e.rank for e in f.enemies if e.rank > 0]
+                 for f in FormationObject.every])
+            for f, base_rank in zip(FormationObject.every, base_ranks):
+                f._base_rank = base_rank
+                f._rank = f._base_rank
+        else:
+            for f in FormationObject.every:
+                enemy_ranks = [e.rank for e in f.enemies if e.rank > 0]
+                if not enemy_ranks:
+                    f._base_rank = -1
+                else:
+                    f._base_rank = (max(enemy_ranks) *
+                                    (sum(enemy_ranks)**0.0625))
+                f._rank = f._base_rank
 
         companion_dict = defaultdict(set)
         for fp in FourPackObject.every:
@@ -1593,6 +1715,16 @@ class FormationObject(TableObject):
             for f in formations:
                 companion_dict[f] |= formations
 
+        if rankarrays.USE_NUMPY:
+            formations = FormationObject.every
+            ranks = rankarrays.companion_ranks(
+                [f._base_rank for f in formations],
+                [[f2.index for f2 in companion_dict[f]]
+                 if f in companion_dict else [] for f in formations])
+            for f, rank in zip(formations, ranks):
+                f._rank = rank
+            return self.rank
+
         for f in FormationObject.every:
             if f in companion_dict:
                 companion_rank = (
@@ -1618,28 +1750,46 @@ class MonsterAIObject(TableObject):
                0xFC: 3, 0xFD: 0, 0xFE: 0, 0xFF: 0
                }
 
-    @cached_property
-    def ai_script(self):
-        pointer = addresses.ai_scripts_address + self.ai_pointer
-        f = open(get_outfile(), 'r+b')
-        f.seek(pointer)
+    @classmethod
+    def tokenize_script(cls, data, address):
         script = []
         seen = False
         while True:
-            value = f.read(1)
-            try:
-                numargs = self.AICODES[ord(value)]
-                args = f.read(numargs)
-            except KeyError:
-                args = b''
-            script.append(value + args)
-            if ord(value) == 0xFF:
+            value = data[address]
+            numargs = cls.AICODES.get(value, 0)
+            script.append(bytes(data[address:address+1+numargs]))
+            address += 1 + numargs
+            if value == 0xFF:
                 if seen:
-                    break
+                    return script, address
                 else:
                     seen = True
-        f.close()
-        return script
+
+    @classproperty
+    def ai_scripts(cls):
+        if hasattr(MonsterAIObject, '_ai_scripts'):
+            return MonsterAIObject._ai_scripts
+
+        base = addresses.ai_scripts_address
+        pointers = sorted({o.ai_pointer for o in MonsterAIObject.every})
+        scripts = {}
+        with memoryview(get_rom().data) as data:
+            # scripts are stored back to back, so a single pass from the
+            # first one finds nearly all of them
+            address = base + pointers[0]
+            while address - base <= pointers[-1]:
+                scripts[address - base], address = cls.tokenize_script(
+                    data, address)
+            for pointer in pointers:
+                if pointer not in scripts:
+                    scripts[pointer], _ = cls.tokenize_script(
+                        data, base + pointer)
+        MonsterAIObject._ai_scripts = scripts
+        return MonsterAIObject.ai_scripts
+
+    @property
+    def ai_script(self):
+        return self.ai_scripts[self.ai_pointer]
 
     @cached_property
     def hp_refills(self):
@@ -1671,19 +1821,18 @@ class MonsterNameObject(TableObject):
     @classmethod
     def full_cleanup(cls):
         if hasattr(addresses, 'sort_rages_address'):
-            f = open(get_outfile(), 'r+b')
+            rom = get_rom()
             counter = 0
             for mno in sorted(MonsterNameObject.every, key=lambda n: n.name):
                 if mno.index >= 0x100:
                     continue
-                f.seek(addresses.sort_rages_address + counter)
-                f.write(bytes([mno.index]))
+                rom.write(addresses.sort_rages_address + counter,
+                          bytes([mno.index]), 'sort_rages')
                 if hasattr(addresses, 'myself_rages_address'):
-                    f.seek(addresses.myself_rages_address + counter)
-                    f.write(bytes([mno.index]))
+                    rom.write(addresses.myself_rages_address + counter,
+                              bytes([mno.index]), 'sort_rages')
                 counter += 1
             assert counter <= 0x100
-            f.close()
 
         super(MonsterNameObject, cls).full_cleanup()
 
@@ -1854,33 +2003,41 @@ class ItemObject(TableObject):
         # TODO: also consider morphs?
         tier0 = [i for i in ItemObject.every if i.is_buyable]
         tier0 = sorted(tier0, key=lambda i: (i.is_buyable, i.signature))
+        tiered = set(tier0)
         tier1 = [i for i in ItemObject.every
-                 if i.is_farmable and i not in tier0]
+                 if i.is_farmable and i not in tiered]
         tier1 = sorted(tier1, key=lambda i: (i.is_farmable, i.signature))
+        tiered |= set(tier1)
         tier2b = [i for i in ItemObject.every
-                  if i.is_boss_loot and i not in tier0 + tier1]
+                  if i.is_boss_loot and i not in tiered]
         tier2b = sorted(tier2b,
                         key=lambda i: (i.is_boss_loot, i.signature))
         tier2c = [i for i in ItemObject.every
-                  if i.is_chest and i not in tier0 + tier1]
+                  if i.is_chest and i not in tiered]
         tier2c = sorted(tier2c, key=lambda i: (i.is_chest, i.signature),
                         reverse=True)
+        positions_b = {i: n for (n, i) in enumerate(tier2b)}
+        positions_c = {i: n for (n, i) in enumerate(tier2c)}
         tier2 = [i for i in ItemObject.every
-                 if i in tier2b and i in tier2c]
+                 if i in positions_b and i in positions_c]
         tier2 = sorted(
-            tier2, key=lambda i: ((tier2b.index(i)/(len(tier2b)-1)) +
-                                  (tier2c.index(i)/(len(tier2c)-1)),
+            tier2, key=lambda i: ((positions_b[i]/(len(tier2b)-1)) +
+                                  (positions_c[i]/(len(tier2c)-1)),
                                   i.signature))
+        tiered |= set(tier2)
         tier3 = [i for i in ItemObject.every
-                 if i in tier2b + tier2c and i not in tier2]
+                 if (i in positions_b or i in positions_c)
+                 and i not in tiered]
 
         def t3_sorter(i):
-            mylist = tier2b if i in tier2b else tier2c
-            return (mylist.index(i) / (len(mylist)-1), i.signature)
+            if i in positions_b:
+                return (positions_b[i] / (len(tier2b)-1), i.signature)
+            return (positions_c[i] / (len(tier2c)-1), i.signature)
 
         tier3 = sorted(tier3, key=t3_sorter)
+        tiered |= set(tier3)
         tier4 = [i for i in ItemObject.every if i.is_legit and
-                 i not in tier0 + tier1 + tier2 + tier3]
+                 i not in tiered]
         tier4 = sorted(tier4, key=lambda i: i.signature)
 
         full_list = tier0 + tier1 + tier2 + tier3 + tier4
@@ -1888,17 +2045,17 @@ class ItemObject(TableObject):
         assert len(full_list) == len(set(full_list))
         full_list = [i for i in full_list if i.is_legit]
 
-        for i in full_list:
-            i._rank_no_colosseum = full_list.index(i)
+        for n, i in enumerate(full_list):
+            i._rank_no_colosseum = n
 
+        buyable_ranks = [i2._rank_no_colosseum
+                         for i2 in full_list if i2.is_buyable]
         for i in full_list:
             i._rank = i._rank_no_colosseum
             if i.is_colosseum:
                 colosseum_rank = min(i2._rank_no_colosseum
                                      for i2 in i.is_colosseum)
-                colosseum_rank = max(
-                    colosseum_rank, max(i2._rank_no_colosseum
-                                        for i2 in full_list if i2.is_buyable))
+                colosseum_rank = max(colosseum_rank, max(buyable_ranks))
                 if 0 < colosseum_rank < i._rank_no_colosseum:
                     i._rank = (colosseum_rank + i._rank_no_colosseum) / 2
 
@@ -1925,8 +2082,8 @@ class ItemObject(TableObject):
                 full_list, key=lambda i: (tiers[i.index], i._rank,
                                           i.signature))
 
-        for i in full_list:
-            i._rank = full_list.index(i)
+        for n, i in enumerate(full_list):
+            i._rank = n
 
         for i in ItemObject.every:
             if i.index in BANNED_INDEXES or not hasattr(i, '_rank'):
@@ -2514,26 +2671,24 @@ class NatMagCharObject(TableObject):
         assert self.old_data['character_index'] in {0, 6}
         other = NatMagCharObject.get(self.index ^ 1)
         assert self.character_index != other.character_index
-        with open(get_outfile(), 'r+b') as f:
-            if 'JP' in get_global_label():
-                pointer = 0xa0b8 + (4 * self.index)
-            else:
-                pointer = 0xa183 + (4 * self.index)
-            f.seek(pointer-1)
-            validate = f.read(2)
-            expected = b'\xc9' + bytes([self.old_data['character_index']])
-            assert validate == expected
-            f.seek(pointer)
-            f.write(bytes([self.character_index]))
-            if 'JP' in get_global_label():
-                pointer = 0xa0e1 + (34 * self.index)
-            else:
-                pointer = 0xa1ac + (34 * self.index)
-            address = 0x1a6e + (54 * self.character_index)
-            #f.seek(pointer)
-            #old_address = int.from_bytes(f.read(2), byteorder='little')
-            f.seek(pointer)
-            f.write(address.to_bytes(2, byteorder='little'))
+        rom = get_rom()
+        if 'JP' in get_global_label():
+            pointer = 0xa0b8 + (4 * self.index)
+        else:
+            pointer = 0xa183 + (4 * self.index)
+        validate = rom.read(pointer-1, 2)
+        expected = b'\xc9' + bytes([self.old_data['character_index']])
+        assert validate == expected
+        rom.write(pointer, bytes([self.character_index]), 'natural_magic')
+        if 'JP' in get_global_label():
+            pointer = 0xa0e1 + (34 * self.index)
+        else:
+            pointer = 0xa1ac + (34 * self.index)
+        address = 0x1a6e + (54 * self.character_index)
+        #old_address = int.from_bytes(rom.read(pointer, 2),
+        #                             byteorder='little')
+        rom.write(pointer, address.to_bytes(2, byteorder='little'),
+                  'natural_magic')
 
 
 class NaturalMagicMixin(TableObject):
@@ -2720,13 +2875,13 @@ class CharacterObject(TableObject):
                     commands.insert(0, chosen)
 
         NO_RAGE_PATCH = True
-        for patchfilename in get_activated_patches():
+        for patchfilename in applied_patches():
             if 'auto_learn_rage_patch' in patchfilename.lower():
                 NO_RAGE_PATCH = False
                 break
         else:
             if 'BNW' in get_global_label():
-                write_patch(get_outfile(), 'auto_learn_rage_patch.txt')
+                apply_patch('auto_learn_rage_patch.txt')
                 NO_RAGE_PATCH = False
 
         if self.index == 0x0b and 0x11 not in commands and NO_RAGE_PATCH:
@@ -3139,25 +3294,20 @@ class CharEsperObject(TableObject):
 def number_location_names():
     if 'JP' in get_global_label():
         raise NotImplementedError
-    pointer = addresses.location_names
-    f = open(get_outfile(), 'r+b')
-    f.seek(pointer)
-    f.write(b'\x00')
+    names = b'\x00'
     for i in range(1, 101):
-        pointer = f.tell() - addresses.location_names
-        LocNamePtrObject.get(i).name_pointer = pointer
+        LocNamePtrObject.get(i).name_pointer = len(names)
         s = '{0:0>2}'.format(i)
         for c in s:
             v = int(c)
-            f.write(bytes([0x54 + v]))
-        f.write(b'\x00')
-    assert f.tell() <= addresses.location_names_max
-    f.close()
-
-
-fanatix_space_pointer = None
+            names += bytes([0x54 + v])
+        names += b'\x00'
+    assert addresses.location_names + len(names) <= (
+        addresses.location_names_max)
+    get_rom().write(addresses.location_names, names, 'location_names')
 
 
+@timed('execute_fanatix_mode')
 def execute_fanatix_mode():
     if not FOOLS:
         print('FANATIX MODE ACTIVATED')
@@ -3258,15 +3408,14 @@ def execute_fanatix_mode():
         0x6B, 0x01, 0x20, 160, 127, 0x00, 0xFF,     # start at fanatics tower
         0xFE,
         ]
-    fo = open(get_outfile(), 'r+b')
-    fo.seek(addresses.opening_crawl_pointer)
-    fo.write(bytes([0xFD]*4))  # no opening crawl
+    rom = get_rom()
+    rom.write(addresses.opening_crawl_pointer,
+              bytes([0xFD]*4), 'fanatix')  # no opening crawl
     opening_jump_pointer = addresses.opening_jump_pointer
-    fo.seek(addresses.opening_pointer)
-    fo.write(bytes(
-        [0xB2] + int_to_bytelist(opening_jump_pointer-0xA0000, 3) + [0xFE]))
-    fo.seek(opening_jump_pointer)
-    fo.write(bytes(opening_event))
+    rom.write(addresses.opening_pointer, bytes(
+        [0xB2] + int_to_bytelist(opening_jump_pointer-0xA0000, 3) + [0xFE]),
+        'fanatix')
+    rom.write(opening_jump_pointer, bytes(opening_event), 'fanatix')
 
     partydict, fulldict = {}, {}
     removedict, addict = {}, {}
@@ -3316,29 +3465,27 @@ def execute_fanatix_mode():
         assert len(fulldict[n]) in [5, 6]
         done_parties.add(party)
 
+    event_addresses = {}
+
     def write_event(script):
-        global fanatix_space_pointer
-        if fanatix_space_pointer is None:
-            fanatix_space_pointer = addresses.fanatix_space_pointer
-
-        limit = -1
-        if fanatix_space_pointer < addresses.fanatix_space_limit:
-            assert fanatix_space_pointer >= addresses.fanatix_space_pointer
-            limit = addresses.fanatix_space_limit
-            if fanatix_space_pointer + len(script) > limit:
-                fanatix_space_pointer = addresses.fanatix_space_pointer_2
-        if fanatix_space_pointer >= addresses.fanatix_space_limit:
-            assert fanatix_space_pointer >= addresses.fanatix_space_pointer_2
-            limit = addresses.fanatix_space_limit_2
-            if fanatix_space_pointer + len(script) > limit:
-                raise Exception('Not enough space.')
-
-        old_pointer = fanatix_space_pointer
-        fo.seek(fanatix_space_pointer)
-        fo.write(bytes(script))
-        fanatix_space_pointer += len(script)
-        assert fanatix_space_pointer <= limit
-        return old_pointer
+        # scripts that jump within themselves are given as a function of
+        # their own event address; any other script is written only once
+        if callable(script):
+            length = len(script(0))
+        else:
+            script = bytes(script)
+            if script in event_addresses:
+                return event_addresses[script]
+            length = len(script)
+        pointer = ROM_SPACE.allocate(length, 'fanatix', 'write_event')
+        if callable(script):
+            script = bytes(script(pointer - 0xA0000))
+            assert len(script) == length
+        else:
+            event_addresses[script] = pointer
+        if not PLAN_MODE:
+            get_rom().write(pointer, script, 'write_event')
+        return pointer
 
     sortuple = lambda x: tuple(sorted(x))
     partial_dict = {}
@@ -3541,8 +3688,8 @@ def execute_fanatix_mode():
              and not set(p.formation_ids) & BANNED_FORMATIONS]
     done_packs = set([])
     chosen_packs = []
-    boss_ranks = [bp.rank for bp in boss_packs]
-    random_ranks = [p.rank for p in packs]
+    boss_ranks = PackObject.get_ranks(boss_packs)
+    random_ranks = PackObject.get_ranks(packs)
     minboss, maxboss = min(boss_ranks), max(boss_ranks)
     minrandom, maxrandom = min(random_ranks), max(random_ranks)
     lowratio, highratio = (minrandom / minboss), (maxrandom / maxboss)
@@ -3625,6 +3772,7 @@ def execute_fanatix_mode():
         chosen_music[f] = valid_songs[int(round(max_index*ratio))]
 
     prev, previous_npc = None, None
+    npc_choices = []
     done_shops = set([])
     dummy = ChestObject.create_new()
     dummy.groupindex = 0
@@ -3790,28 +3938,31 @@ def execute_fanatix_mode():
             candidates = [c for c in candidates if c != previous_npc]
             npc_choice = random.choice(candidates)
         previous_npc = npc_choice
+        npc_choices.append(npc_choice)
         if npc_choice == 'save_point':
-            pointer = fanatix_space_pointer - 0xA0000
-            npc.become_pay_save(pointer, price, price_message,
-                                pay_save_command, write_event)
+            npc.become_pay_save(price, price_message, pay_save_command,
+                                write_event)
         elif npc_choice == 'inn':
             npc.graphics = 0x1E
             npc.set_palette(3)
             if price in done_pay_inns:
                 npc.set_event_addr(done_pay_inns[price])
             else:
-                pointer = fanatix_space_pointer - 0xA0000
-                yes_p = pointer + 13
-                no_p = yes_p + 7
-                script = [
-                    0x4B] + int_to_bytelist(price_message, 2) + [   # show $$$
-                    0x4B] + int_to_bytelist(addresses.inn_ask_message, 2) + [
-                    0xB6] + (int_to_bytelist(yes_p, 3) +
-                             int_to_bytelist(no_p, 3)) + [
-                    0x85] + int_to_bytelist(price, 2)               # take $$$
-                script += pay_inn_command + [0xFE]
-                assert script[no_p-pointer:] == [0xFE]
-                event_addr = write_event(script) - 0xA0000
+                def inn_script(pointer):
+                    yes_p = pointer + 13
+                    no_p = yes_p + 7
+                    script = [
+                        0x4B] + int_to_bytelist(price_message, 2) + [  # $$$
+                        0x4B] + int_to_bytelist(addresses.inn_ask_message,
+                                                2) + [
+                        0xB6] + (int_to_bytelist(yes_p, 3) +
+                                 int_to_bytelist(no_p, 3)) + [
+                        0x85] + int_to_bytelist(price, 2)       # take $$$
+                    script += pay_inn_command + [0xFE]
+                    assert script[no_p-pointer:] == [0xFE]
+                    return script
+
+                event_addr = write_event(inn_script) - 0xA0000
                 npc.set_event_addr(event_addr)
                 done_pay_inns[price] = npc.event_addr
         elif npc_choice == 'colosseum':
@@ -3878,6 +4029,19 @@ def execute_fanatix_mode():
         l.music = chosen_music[n]
         prev = l
 
+    PLAN['fanatix'] = {
+        'parties': [list(partydict[n]) for n in range(NUM_FLOORS)],
+        'added': [addict[n] for n in range(NUM_FLOORS)],
+        'removed': [removedict.get(n) for n in range(NUM_FLOORS)],
+        'boss_packs': [p.index for p in boss_packs],
+        'chosen_packs': [p.index for p in chosen_packs],
+        'chosen_items': [i.index for i in chosen_items],
+        'chosen_music': [chosen_music[n] for n in range(NUM_FLOORS)],
+        'esper_floors': {n: e for (n, e) in sorted(esper_floors.items())},
+        'colosseum_floors': sorted(colosseum_floors),
+        'npcs': npc_choices,
+        }
+
     # top section
     LocationObject.class_reseed('postfanatix')
     assert next_membit <= 0x100
@@ -3901,9 +4065,8 @@ def execute_fanatix_mode():
     npc = NpcObject.create_new()
     npc.groupindex = tower_roof.index
     npc.x, npc.y = 4, 5
-    pointer = fanatix_space_pointer - 0xA0000
     price = min(price_message_indexes)
-    npc.become_pay_save(pointer, price, price_message_indexes[price],
+    npc.become_pay_save(price, price_message_indexes[price],
                         pay_save_command, write_event)
 
     npc = NpcObject.create_new()
@@ -4008,21 +4171,19 @@ def execute_fanatix_mode():
         0xB2] + int_to_bytelist(addresses.ending_pointer-0xA0000, 3) + [
         0xFE,
         ]
-    fo.seek(addresses.final_pointer)
-    fo.write(bytes(script))
+    rom.write(addresses.final_pointer, bytes(script), 'fanatix')
 
     if 'BNW' in get_global_label():
         DialoguePtrObject.bring_back_auction_prices()
-        fo.seek(addresses.cheatproof_addr)
-        fo.write(bytes(
-            [0xB2] + int_to_bytelist(addresses.final_pointer-0xA0000, 3)))
+        rom.write(addresses.cheatproof_addr, bytes(
+            [0xB2] + int_to_bytelist(addresses.final_pointer-0xA0000, 3)),
+            'fanatix')
 
     tower_roof.set_bit('enable_encounters', False)
     tower_roof.set_bit('warpable', False)
 
-    fo.close()
-
 
+@timed('write_seed')
 def write_seed():
     if not hasattr(addresses, 'aux_seed_address'):
         return
@@ -4046,81 +4207,151 @@ def write_seed():
     s += b'\x00'
     assert len(s) == length
 
-    f = open(get_outfile(), 'r+b')
-    f.seek(address)
-    f.write(s)
-    f.close()
+    get_rom().write(address, s, 'write_seed')
 
 
+@timed('handle_exhirom')
 def handle_exhirom():
-    with open(get_outfile(), 'r+b') as f:
-        f.seek(0x8000)
-        block = f.read(0x8000)
-        f.seek(0x408000)
-        empty = f.read(0x8000)
-        assert empty in [block, b'\x00'*0x8000]
-        f.seek(0x408000)
-        f.write(block)
-
-
-if __name__ == '__main__':
-    try:
-        print('You are using the Beyond Chaos Gaiden '
-              'randomizer version %s.' % VERSION)
-
-        ALL_OBJECTS = [g for g in globals().values()
-                       if isinstance(g, type) and issubclass(g, TableObject)
-                       and g not in [TableObject]]
+    rom = get_rom()
+    block = rom.read(0x8000, 0x8000)
+    empty = rom.read(0x408000, 0x8000)
+    assert empty in [block, b'\x00'*0x8000]
+    rom.write(0x408000, block, 'handle_exhirom')
 
-        codes = {
-            'fanatix': ['fanatix'],
-            'wildcommands': ['wildcommands'],
-            'easymodo': ['easymodo'],
-        }
-
-        run_interface(ALL_OBJECTS, snes=True, codes=codes,
-                      custom_degree=True, custom_difficulty=True)
 
-        tm = gmtime(get_seed())
-        if tm.tm_mon == 4 and tm.tm_mday == 1:
-            activate_code('fanatix')
-            FOOLS = True
-
-        if CmdChangeFBObject.flag in get_flags():
-            if get_global_label() in ['FF6_NA_1.0', 'FF6_NA_1.1']:
-                write_patch(get_outfile(), 'command_shuffle_patch.txt')
-            elif 'FF6_JP' in get_global_label():
-                write_patch(get_outfile(), 'command_shuffle_patch_jp.txt')
-            elif 'BNW_1' in get_global_label():
-                write_patch(get_outfile(), 'command_shuffle_patch_bnw1.txt')
-            elif 'BNW_2' in get_global_label():
-                write_patch(get_outfile(), 'command_shuffle_patch_bnw2.txt')
+CODES = {
+    'fanatix': ['fanatix'],
+    'wildcommands': ['wildcommands'],
+    'easymodo': ['easymodo'],
+    }
 
-        if 'easymodo' in get_activated_codes():
-            'EASY MODE ACTIVATED'
 
-        if 'fanatix' in get_activated_codes():
-            if get_global_label() in ['FF6_NA_1.0', 'FF6_NA_1.1']:
-                write_patch(get_outfile(), 'auto_learn_rage_patch.txt')
-            if 'JP' in get_global_label():
-                write_patch(get_outfile(), 'let_banon_equip_patch_jp.txt')
-                write_patch(get_outfile(), 'auto_learn_rage_patch_jp.txt')
-            elif 'SAFE_MODE' not in get_global_label():
-                write_patch(get_outfile(), 'let_banon_equip_patch.txt')
-            execute_fanatix_mode()
-
-        hexify = lambda x: '{0:0>2}'.format('%x' % x)
-        numify = lambda x: '{0: >3}'.format(x)
-        minmax = lambda x: (min(x), max(x))
+def collect_objects():
+    global ALL_OBJECTS
+    ALL_OBJECTS = [g for g in globals().values()
+                   if isinstance(g, type) and issubclass(g, TableObject)
+                   and g not in [TableObject]]
+    return ALL_OBJECTS
+
+
+def reserve_rom_space():
+    global ROM_SPACE
+    ROM_SPACE = RomSpace()
+    for filename in sorted(applied_patches()):
+        if filename.endswith('.txt'):
+            reserve_patch(filename)
+    ROM_SPACE.reserve(addresses.fanatix_space_pointer,
+                      addresses.fanatix_space_limit, 'fanatix')
+    ROM_SPACE.reserve(addresses.fanatix_space_pointer_2,
+                      addresses.fanatix_space_limit_2, 'fanatix')
+    start, end = [int(a, 0x10) for a in MUSIC_FREESPACE.split('-')]
+    ROM_SPACE.reserve(start, end + 1, 'johnnydmad')
+    for start, end in DialoguePtrObject.dialogue_banks:
+        ROM_SPACE.reserve(start, end, 'dialogue')
+    if hasattr(addresses, 'aux_seed_address'):
+        ROM_SPACE.reserve(
+            addresses.aux_seed_address,
+            addresses.aux_seed_address + addresses.aux_seed_length,
+            'write_seed')
+
+
+def randomize_rom():
+    global FOOLS
+    reserve_rom_space()
+    tm = gmtime(get_seed())
+    if tm.tm_mon == 4 and tm.tm_mday == 1:
+        activate_code('fanatix')
+        FOOLS = True
+
+    if CmdChangeFBObject.flag in get_flags():
+        if get_global_label() in ['FF6_NA_1.0', 'FF6_NA_1.1']:
+            apply_patch('command_shuffle_patch.txt')
+        elif 'FF6_JP' in get_global_label():
+            apply_patch('command_shuffle_patch_jp.txt')
+        elif 'BNW_1' in get_global_label():
+            apply_patch('command_shuffle_patch_bnw1.txt')
+        elif 'BNW_2' in get_global_label():
+            apply_patch('command_shuffle_patch_bnw2.txt')
+
+    if 'easymodo' in get_activated_codes():
+        'EASY MODE ACTIVATED'
+
+    if 'fanatix' in get_activated_codes():
+        if get_global_label() in ['FF6_NA_1.0', 'FF6_NA_1.1']:
+            apply_patch('auto_learn_rage_patch.txt')
+        if 'JP' in get_global_label():
+            apply_patch('let_banon_equip_patch_jp.txt')
+            apply_patch('auto_learn_rage_patch_jp.txt')
+        elif 'SAFE_MODE' not in get_global_label():
+            apply_patch('let_banon_equip_patch.txt')
+        execute_fanatix_mode()
 
+    if not PLAN_MODE:
         write_seed()
         handle_exhirom()
 
+    with timed('clean_and_write'), external_write('clean_and_write'):
         clean_and_write(ALL_OBJECTS)
-        rewrite_snes_meta('BCG-R', VERSION, lorom=False)
+    flush_rom()
+    if not PLAN_MODE:
+        with timed('rewrite_snes_meta'):
+            rewrite_snes_meta('BCG-R', VERSION, lorom=False)
+
+
+def enable_plan_mode():
+    # not a dry run: patches, music and the like still go into the rom, so
+    # every randomization decision comes out the same; only fanatix events,
+    # table writes and the final header are skipped
+    global PLAN_MODE
+    PLAN_MODE = True
+    skip_write = classmethod(lambda cls, *args, **kwargs: None)
+    for o in ALL_OBJECTS:
+        o.write_all = skip_write
+
+
+def plan_spoiler():
+    jsonable = lambda v: list(v) if isinstance(v, (bytes, list, tuple)) else v
+    changes = {}
+    for cls in sorted(ALL_OBJECTS, key=lambda c: c.__name__):
+        if hasattr(cls, 'flag') and cls.flag not in get_flags():
+            continue
+        for o in cls.every:
+            changed = {}
+            for attr, old in sorted(o.old_data.items()):
+                new = getattr(o, attr, None)
+                if new != old:
+                    changed[attr] = [jsonable(old), jsonable(new)]
+            if changed:
+                changes.setdefault(cls.__name__, {})[o.index] = changed
+    return {'version': VERSION, 'label': get_global_label(),
+            'seed': get_seed(), 'flags': get_flags(),
+            'codes': sorted(get_activated_codes()),
+            'fanatix': PLAN.get('fanatix'), 'space': ROM_SPACE.report(),
+            'changes': changes}
+
+
+def main():
+    print('You are using the Beyond Chaos Gaiden '
+          'randomizer version %s.' % VERSION)
+
+    collect_objects()
+    instrument_objects(ALL_OBJECTS)
+    with timed('run_interface'):
+        run_interface(ALL_OBJECTS, snes=True, codes=CODES,
+                      custom_degree=True, custom_difficulty=True)
+    randomize_rom()
+    if environ.get('BCG_METRICS'):
+        write_report('%s.metrics.jsonl' % get_outfile().rsplit('.', 1)[0],
+                     stage='seed', seed=get_seed(), flags=get_flags(),
+                     codes=sorted(get_activated_codes()), version=VERSION,
+                     label=get_global_label())
+
+    finish_interface()
 
-        finish_interface()
 
+if __name__ == '__main__':
+    try:
+        main()
     except Exception:
         print('ERROR: %s' % format_exc())
         input('Press Enter to close this program. ')
@@ -0,0 +1,93 @@
+from importlib import import_module
+
+
+# numpy is only worth it for tables much larger than ff6's, and importing it
+# costs more than it saves there, so it is off unless asked for
+numpy = None
+USE_NUMPY = False
+
+
+def use_numpy(enabled=True):
+    global numpy, USE_NUMPY
+    if enabled and numpy is None:
+        try:
+            numpy = import_module('numpy')
+        except ImportError:
+            pass
+    USE_NUMPY = enabled and numpy is not None
+
+
+def padded(rows, fill=0.0):
+    width = max([len(row) for row in rows] + [1])
+    matrix = numpy.full((len(rows), width), fill)
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = row
+    return matrix
+
+
+def row_sums(matrix):
+    # one column at a time, so each row is added up in the same order as
+    # sum() would, and rounds the same way; padding adds exact zeros
+    totals = numpy.zeros(matrix.shape[0])
+    for column in matrix.T:
+        totals += column
+    return totals
+
+
+def ranked(ranks, valid):
+    # unranked rows are the int -1, as in the python versions
+    return [rank if ok else -1
+            for (rank, ok) in zip(ranks.tolist(), valid.tolist())]
+
+
+def monster_base_ranks(positions_a, positions_b, level_multiplier,
+                       hp_multiplier):
+    # positions are -1 for monsters that are not ranked
+    eligible = numpy.array(positions_a) >= 0
+    a = numpy.array(positions_a) * float(level_multiplier)
+    b = numpy.array(positions_b) * float(hp_multiplier)
+    return ranked(numpy.maximum(a, b) * (a + b), eligible)
+
+
+def formation_base_ranks(enemy_ranks):
+    # only the positive ranks of each formation's enemies
+    matrix = padded(enemy_ranks)
+    counts = numpy.array([len(r) for r in enemy_ranks])
+    # python's own pow, as numpy's may round differently
+    powers = numpy.array([s ** 0.0625 for s in row_sums(matrix).tolist()])
+    return ranked(matrix.max(axis=1) * powers, counts > 0)
+
+
+def companion_ranks(base, companions, fixed=None, default=None):
+    # companions are lists of indexes into base, in the order the python
+    # version adds them up; rows that are fixed keep their base rank, as do
+    # rows without companions unless there is a default
+    values = numpy.array(base, dtype=float)
+    counts = numpy.array([len(c) for c in companions])
+    has_companions = counts > 0
+    sums = row_sums(padded([values[c] for c in companions]))
+    companion_rank = sums / numpy.maximum(counts, 1)
+    if (has_companions & (companion_rank == 0)).any():
+        raise ZeroDivisionError
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        similarity = values / companion_rank
+        similarity = numpy.where(similarity > 1, 1 / similarity, similarity)
+        ratio = similarity / 2
+        ranks = (values * (1 - ratio)) + (companion_rank * ratio)
+    # rows that are not worked out keep the values they were given
+    ranks = ranks.tolist()
+    for i, row in enumerate(companions):
+        if fixed is not None and fixed[i]:
+            ranks[i] = base[i]
+        elif not row:
+            ranks[i] = base[i] if default is None else default
+    return ranks
+
+
+def pack_ranks(formation_ranks, weights):
+    ranks = padded(formation_ranks)
+    weights = padded(weights)
+    totals = numpy.zeros(ranks.shape[0])
+    for w, r in zip(weights.T, ranks.T):
+        totals += (w / weights.sum(axis=1)) * r
+    return ranked(totals, ~(ranks < 0).any(axis=1))
@@ -0,0 +1,132 @@
+from zlib import crc32
+
+
+BLOCK_SIZE = 0x1000
+IPS_MAX_ADDRESS = 0xFFFFFF
+IPS_MAX_RECORD = 0xFFFF
+IPS_EOF = 0x454F46
+
+
+def diff_runs(source, target, gap=8):
+    # compare whole blocks first; only blocks that differ are scanned
+    # byte by byte
+    length = min(len(source), len(target))
+    runs = []
+    for block in range(0, length, BLOCK_SIZE):
+        end = min(block + BLOCK_SIZE, length)
+        if source[block:end] == target[block:end]:
+            continue
+        start = None
+        for i in range(block, end):
+            if source[i] != target[i]:
+                if start is None:
+                    start = i
+            elif start is not None:
+                runs.append((start, i))
+                start = None
+        if start is not None:
+            runs.append((start, end))
+    if len(target) > length:
+        runs.append((length, len(target)))
+
+    merged = []
+    for start, end in runs:
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def make_ips(source, target):
+    if len(source) != len(target):
+        raise Exception('IPS patches cannot change the rom size.')
+    patch = bytearray(b'PATCH')
+    for start, end in diff_runs(source, target):
+        if start == IPS_EOF:
+            start -= 1
+        while start < end:
+            if start > IPS_MAX_ADDRESS:
+                raise Exception('Address too large for an IPS patch.')
+            length = min(end - start, IPS_MAX_RECORD)
+            patch += start.to_bytes(3, byteorder='big')
+            patch += length.to_bytes(2, byteorder='big')
+            patch += target[start:start+length]
+            start += length
+            if start == IPS_EOF and start < end:
+                start -= 1
+    patch += b'EOF'
+    return bytes(patch)
+
+
+def bps_number(value):
+    data = bytearray()
+    while True:
+        low = value & 0x7F
+        value >>= 7
+        if value == 0:
+            data.append(0x80 | low)
+            return data
+        data.append(low)
+        value -= 1
+
+
+def make_bps(source, target, rle_threshold=0x20):
+    patch = bytearray(b'BPS1')
+    patch += bps_number(len(source))
+    patch += bps_number(len(target))
+    patch += bps_number(0)
+
+    SOURCE_READ, TARGET_READ, TARGET_COPY = 0, 1, 3
+    action = lambda command, length: bps_number(((length-1) << 2) | command)
+
+    output_offset = 0
+    target_relative = 0
+    for start, end in diff_runs(source, target):
+        if start > output_offset:
+            patch += action(SOURCE_READ, start - output_offset)
+        pointer = start
+        while pointer < end:
+            value = target[pointer]
+            run_end = pointer + 1
+            while run_end < end and target[run_end] == value:
+                run_end += 1
+            literal_end = run_end
+            if run_end - pointer < rle_threshold:
+                # extend the literal up to the next long run
+                literal_end = pointer
+                while literal_end < end:
+                    value = target[literal_end]
+                    run_end = literal_end + 1
+                    while run_end < end and target[run_end] == value:
+                        run_end += 1
+                    if run_end - literal_end >= rle_threshold:
+                        break
+                    literal_end = run_end
+                patch += action(TARGET_READ, literal_end - pointer)
+                patch += target[pointer:literal_end]
+                pointer = literal_end
+                continue
+
+            # one literal byte, then copy it forward over itself
+            patch += action(TARGET_READ, 1)
+            patch += target[pointer:pointer+1]
+            delta = pointer - target_relative
+            patch += action(TARGET_COPY, run_end - pointer - 1)
+            patch += bps_number((abs(delta) << 1) | (delta < 0))
+            target_relative = pointer + (run_end - pointer - 1)
+            pointer = run_end
+        output_offset = end
+    if output_offset < len(target):
+        patch += action(SOURCE_READ, len(target) - output_offset)
+
+    patch += crc32(source).to_bytes(4, byteorder='little')
+    patch += crc32(target).to_bytes(4, byteorder='little')
+    patch += crc32(patch).to_bytes(4, byteorder='little')
+    return bytes(patch)
+
+
+def make_patch(source, target):
+    if len(source) == len(target) and len(target) <= IPS_MAX_ADDRESS:
+        return 'ips', make_ips(source, target)
+    return 'bps', make_bps(source, target)
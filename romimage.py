@@ -0,0 +1,170 @@
+from randomtools.tablereader import get_open_file
+from randomtools.interface import get_outfile
+from romdiff import diff_runs
+from contextlib import contextmanager
+from mmap import mmap
+
+
+ROM = None
+USE_MMAP = False
+JOURNAL = None
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_ranges(ranges, removed):
+    removed = merge_ranges(removed)
+    remaining = []
+    for start, end in ranges:
+        for (rstart, rend) in removed:
+            if rend <= start or rstart >= end:
+                continue
+            if rstart > start:
+                remaining.append((start, rstart))
+            start = max(start, rend)
+            if start >= end:
+                break
+        if start < end:
+            remaining.append((start, end))
+    return remaining
+
+
+def enable_journal():
+    global JOURNAL
+    JOURNAL = []
+
+
+def record_write(start, end, origin):
+    if JOURNAL is not None:
+        JOURNAL.append((start, end, origin))
+
+
+def find_overlaps():
+    # ranges written by more than one origin, merged per pair of origins
+    overlaps = {}
+    active = []
+    for start, end, origin in sorted(JOURNAL or []):
+        active = [a for a in active if a[1] > start]
+        for (astart, aend, aorigin) in active:
+            if aorigin == origin:
+                continue
+            key = tuple(sorted([aorigin, origin]))
+            overlaps.setdefault(key, []).append((start, min(end, aend)))
+        active.append((start, end, origin))
+    return sorted((merged, key) for (key, ranges) in overlaps.items()
+                  for merged in merge_ranges(ranges))
+
+
+class RomImage(object):
+    def __init__(self, filename):
+        self.filename = filename
+        f = get_open_file(filename)
+        f.flush()
+        f.seek(0)
+        self.data = bytearray(f.read())
+        self.dirty = []
+
+    def read(self, address, length):
+        return bytes(self.data[address:address+length])
+
+    def write(self, address, data, origin=None):
+        end = address + len(data)
+        if end > len(self.data):
+            self.data.extend(bytes(end - len(self.data)))
+        self.data[address:end] = data
+        self.dirty.append((address, end))
+        record_write(address, end, origin)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        f = get_open_file(self.filename)
+        for start, end in merge_ranges(self.dirty):
+            f.seek(start)
+            f.write(self.data[start:end])
+        f.flush()
+        self.dirty = []
+
+    def close(self):
+        pass
+
+
+class MappedRomImage(RomImage):
+    # writes go straight to the page cache, so there is nothing to track
+    def __init__(self, filename):
+        self.filename = filename
+        get_open_file(filename).flush()
+        self.file = open(filename, 'r+b')
+        self.data = mmap(self.file.fileno(), 0)
+
+    def write(self, address, data, origin=None):
+        end = address + len(data)
+        if end > len(self.data):
+            self.data.resize(end)
+        self.data[address:end] = data
+        record_write(address, end, origin)
+
+    def flush(self):
+        # a shared map writes straight into the page cache, which ordinary
+        # reads of the file already see, so there is no need to msync;
+        # drop anything randomtools' handle has buffered from before
+        get_open_file(self.filename).flush()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+def use_mmap(enabled=True):
+    global USE_MMAP
+    flush_rom()
+    USE_MMAP = enabled
+
+
+def get_rom():
+    global ROM
+    if ROM is None or ROM.filename != get_outfile():
+        flush_rom()
+        if USE_MMAP:
+            ROM = MappedRomImage(get_outfile())
+        else:
+            ROM = RomImage(get_outfile())
+    return ROM
+
+
+def flush_rom():
+    # randomtools reads and writes the file directly, so the image is handed
+    # back before it does, and reloaded the next time it is needed
+    global ROM
+    if ROM is not None:
+        ROM.flush()
+        ROM.close()
+        ROM = None
+
+
+@contextmanager
+def external_write(origin):
+    # for writes made straight to the file, by randomtools or johnnydmad;
+    # when journaling, the changed ranges are found by comparing the rom
+    # before and after, minus whatever went through the image meanwhile
+    flush_rom()
+    if JOURNAL is None:
+        yield
+        return
+    before = bytes(get_rom().data)
+    flush_rom()
+    mark = len(JOURNAL)
+    yield
+    flush_rom()
+    inner = [(start, end) for (start, end, _) in JOURNAL[mark:]]
+    for start, end in subtract_ranges(diff_runs(before, get_rom().data, 0),
+                                      inner):
+        record_write(start, end, origin)
@@ -0,0 +1,199 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+
+class IntervalIndex(object):
+    # half-open (start, end, owner) intervals, sorted by start; they may
+    # overlap, so each position also keeps the furthest end up to it
+    def __init__(self):
+        self.intervals = []
+        self._max_ends = None
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, start, end, owner):
+        assert start < end
+        insort(self.intervals, (start, end, owner))
+        self._max_ends = None
+
+    @property
+    def max_ends(self):
+        if self._max_ends is None:
+            self._max_ends, furthest = [], -1
+            for _, end, _ in self.intervals:
+                furthest = max(furthest, end)
+                self._max_ends.append(furthest)
+        return self._max_ends
+
+    def is_free(self, start, end):
+        i = bisect_left(self.intervals, (end,))
+        return i == 0 or self.max_ends[i-1] <= start
+
+    def overlapping(self, start, end):
+        found = []
+        i = bisect_left(self.intervals, (end,)) - 1
+        while i >= 0 and self.max_ends[i] > start:
+            if self.intervals[i][1] > start:
+                found.append(self.intervals[i])
+            i -= 1
+        return found[::-1]
+
+
+class RomSpace(object):
+    # regions are claimed by whatever owns them: patches, tables, and the
+    # free space set aside for one purpose; uses are what was written into
+    # that free space
+    def __init__(self):
+        self.regions = IntervalIndex()
+        self.uses = IntervalIndex()
+        self.free = {}
+
+    def reserve(self, start, end, owner):
+        self.regions.add(start, end, owner)
+        self.free = {}
+
+    def is_free(self, start, end):
+        return self.regions.is_free(start, end)
+
+    def owners(self, start, end):
+        return {owner for (_, _, owner)
+                in self.regions.overlapping(start, end)}
+
+    def use(self, start, end, owner, origin=None):
+        if not any(rstart <= start and end <= rend
+                   for (rstart, rend, rowner)
+                   in self.regions.overlapping(start, end)
+                   if rowner == owner):
+            raise Exception('%x-%x is outside of the %s space.' % (
+                start, end-1, owner))
+        if self.owners(start, end) != {owner}:
+            raise Exception('%x-%x is also claimed by %s.' % (
+                start, end-1, ', '.join(sorted(
+                    self.owners(start, end) - {owner}))))
+        if not self.uses.is_free(start, end):
+            raise Exception('%x-%x is already in use.' % (start, end-1))
+        self.uses.add(start, end, origin or owner)
+        if owner in self.free:
+            blocks = self.free[owner]
+            [i] = [i for (i, (fstart, fend)) in enumerate(blocks)
+                   if fstart <= start and end <= fend]
+            fstart, fend = blocks[i]
+            blocks[i:i+1] = [(a, b) for (a, b) in [(fstart, start),
+                                                   (end, fend)] if a < b]
+
+    def free_space(self, owner):
+        # the owner's regions, minus other claims and what is in use
+        if owner not in self.free:
+            blocks = []
+            for start, end, rowner in self.regions.intervals:
+                if rowner != owner:
+                    continue
+                taken = [(a, b) for (a, b, o)
+                         in self.regions.overlapping(start, end) if o != owner]
+                taken += [(a, b) for (a, b, _)
+                          in self.uses.overlapping(start, end)]
+                for a, b in sorted(taken):
+                    if a > start:
+                        blocks.append((start, min(a, end)))
+                    start = max(start, b)
+                if start < end:
+                    blocks.append((start, end))
+            self.free[owner] = blocks
+        return self.free[owner]
+
+    def allocate(self, length, owner, origin=None):
+        # best fit: the smallest free block the data fits in, so large
+        # blocks stay whole for large data
+        candidates = [(end - start, start)
+                      for (start, end) in self.free_space(owner)
+                      if end - start >= length]
+        if not candidates:
+            raise Exception('Not enough space.')
+        _, start = min(candidates)
+        self.use(start, start + length, owner, origin)
+        return start
+
+    def report(self):
+        report = defaultdict(lambda: {'regions': 0, 'size': 0, 'used': 0})
+        for start, end, owner in self.regions.intervals:
+            report[owner]['regions'] += 1
+            report[owner]['size'] += end - start
+            for ustart, uend, _ in self.uses.overlapping(start, end):
+                report[owner]['used'] += min(end, uend) - max(start, ustart)
+        for owner, values in report.items():
+            blocks = [end - start for (start, end) in self.free_space(owner)]
+            free = sum(blocks)
+            values['free_blocks'] = len(blocks)
+            values['largest_free'] = max(blocks) if blocks else 0
+            # the share of free space outside of the largest free block
+            values['fragmentation'] = (
+                round(1 - (values['largest_free'] / float(free)), 4)
+                if free else 0)
+        return dict(report)
+
+
+def patch_values(values, defined):
+    # names defined with .def stand for their bytes, and any other name is
+    # a label for a one byte branch, whose value is not known until the
+    # patch is applied
+    data = []
+    for value in values:
+        if value in defined:
+            data.extend(defined[value])
+            continue
+        try:
+            data.append(int(value, 0x10))
+        except ValueError:
+            data.append(None)
+    return data
+
+
+def read_patch_lines(filename, validation=False):
+    # (address, byte values) for each line of a text patch
+    with open(filename) as f:
+        sections = f.read().split('VALIDATION', 1)
+    if validation and len(sections) < 2:
+        return []
+    text = sections[1] if validation else sections[0]
+    defined = {}
+    lines = []
+    address = None
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        if line.startswith('.def'):
+            name, values = line[len('.def'):].split(None, 1)
+            defined[name] = patch_values(values.split(), defined)
+            continue
+        if line.startswith('.'):
+            continue
+        if ':' in line:
+            label, line = line.split(':', 1)
+            if label.strip():
+                address = int(label, 0x10)
+        data = patch_values(line.split(), defined)
+        lines.append((address, data))
+        if address is not None:
+            address += len(data)
+    return lines
+
+
+def patch_ranges(filename):
+    ranges = []
+    for address, data in read_patch_lines(filename):
+        if not data:
+            continue
+        if ranges and ranges[-1][1] == address:
+            ranges[-1] = (ranges[-1][0], address + len(data))
+        else:
+            ranges.append((address, address + len(data)))
+    return ranges
+
+
+def read_validation(filename):
+    # the bytes a patch expects to find in the rom before it is applied
+    return [(address, bytes(data)) for (address, data)
+            in read_patch_lines(filename, validation=True)
+            if address is not None and None not in data]
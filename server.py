@@ -0,0 +1,122 @@
+from randomtools.tablereader import get_global_label
+from randomtools.interface import get_outfile
+from batch import Job, load_source, output_filename, run_job
+from romdiff import make_patch
+from metrics import report
+import batch
+from randomizer import VERSION
+from argparse import ArgumentParser
+from os import path
+from shutil import rmtree
+from socketserver import ForkingMixIn, UnixStreamServer, StreamRequestHandler
+from tempfile import mkdtemp
+from traceback import format_exc
+import gc
+import json
+import os
+import socket
+
+
+WARM_SOURCE = None
+WARM_TEMPLATE = None
+
+
+def generate_rom(job):
+    tempdir = mkdtemp()
+    try:
+        outfile = output_filename(WARM_SOURCE, job.seed, tempdir)
+        run_job(job, outfile, WARM_TEMPLATE)
+        with open(outfile, 'rb') as f:
+            return f.read()
+    finally:
+        rmtree(tempdir)
+
+
+class SeedRequestHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf8'))
+            job = Job(int(request['seed']) % (10**10),
+                      request.get('flags', ''),
+                      float(request.get('randomness', 0.5)))
+            data = generate_rom(job)
+            kind = 'rom'
+            if request.get('output', 'rom') == 'patch':
+                kind, data = make_patch(batch.SOURCE_DATA, data)
+            header = {'ok': True, 'label': get_global_label(),
+                      'seed': job.seed, 'format': kind,
+                      'metrics': report()['phases'], 'length': len(data)}
+        except Exception:
+            data = b''
+            header = {'ok': False, 'error': format_exc()}
+        self.wfile.write(json.dumps(header).encode('utf8') + b'\n')
+        self.wfile.write(data)
+
+
+class SeedServer(ForkingMixIn, UnixStreamServer):
+    # each request is handled in a child forked from the loaded server,
+    # so every seed starts from the same vanilla objects
+    pass
+
+
+def request_rom(socket_path, seed, flags='', randomness=0.5, output='rom'):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+        request = {'seed': seed, 'flags': flags, 'randomness': randomness,
+                   'output': output}
+        s.sendall(json.dumps(request).encode('utf8') + b'\n')
+        f = s.makefile('rb')
+        header = json.loads(f.readline().decode('utf8'))
+        if not header['ok']:
+            raise Exception(header['error'])
+        data = f.read(header['length'])
+        assert len(data) == header['length']
+        return data
+    finally:
+        s.close()
+
+
+def serve(sourcefile, socket_dir, cache_dir=None):
+    global WARM_SOURCE, WARM_TEMPLATE
+    WARM_SOURCE = sourcefile
+    WARM_TEMPLATE = load_source(sourcefile, cache_dir=cache_dir)
+    os.remove(get_outfile())
+
+    socket_path = path.join(socket_dir, '%s.sock' % get_global_label())
+    if path.exists(socket_path):
+        os.remove(socket_path)
+    gc.freeze()
+    server = SeedServer(socket_path, SeedRequestHandler)
+    print('Serving %s on %s' % (get_global_label(), socket_path))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Beyond Chaos Gaiden seed server v%s' % VERSION)
+    parser.add_argument('sourcefiles', nargs='+')
+    parser.add_argument('--socket-dir', default='.')
+    parser.add_argument('--cache',
+                        help='directory to keep decoded source roms in, so '
+                             'later runs can skip decoding')
+    args = parser.parse_args()
+
+    # randomtools keeps one loaded rom per process, so each source rom
+    # gets its own server process and socket
+    if len(args.sourcefiles) == 1:
+        serve(args.sourcefiles[0], args.socket_dir, args.cache)
+    else:
+        pids = []
+        for sourcefile in args.sourcefiles:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    serve(sourcefile, args.socket_dir, args.cache)
+                except Exception:
+                    print('ERROR: %s\n%s' % (sourcefile, format_exc()))
+                finally:
+                    os._exit(1)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
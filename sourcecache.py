@@ -0,0 +1,62 @@
+from randomizer import VERSION
+import randomtools
+from hashlib import md5
+from os import path, listdir, makedirs, replace
+import pickle
+
+
+BASEPATH = path.dirname(path.abspath(__file__))
+TBLPATH = path.join(BASEPATH, 'tables')
+
+
+def source_hash(data):
+    if len(data) % 0x400 == 0x200:
+        data = data[0x200:]
+    return md5(data).hexdigest()
+
+
+def spec_hash():
+    # anything that changes how tables are decoded: the table files, the
+    # object classes themselves and randomtools, which does the decoding
+    h = md5(VERSION.encode('ascii'))
+    filenames = [path.join(TBLPATH, f) for f in sorted(listdir(TBLPATH))]
+    filenames.append(path.join(BASEPATH, 'randomizer.py'))
+    toolpath = path.dirname(path.abspath(randomtools.__file__))
+    filenames += [path.join(toolpath, f) for f in sorted(listdir(toolpath))
+                  if f.endswith('.py')]
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cache_filename(cache_dir, sourcefile):
+    with open(sourcefile, 'rb') as f:
+        key = '{0}.{1}'.format(source_hash(f.read()), spec_hash()[:16])
+    return path.join(cache_dir, '%s.pickle' % key)
+
+
+def load_cached_objects(cache_dir, sourcefile, objects):
+    filename = cache_filename(cache_dir, sourcefile)
+    if not path.exists(filename):
+        return False
+    with open(filename, 'rb') as f:
+        state = pickle.loads(f.read())
+    # randomtools decodes a class's table the first time its "every" is
+    # used, unless it is already set
+    for o in objects:
+        if o.__name__ in state:
+            o._every = state[o.__name__]
+    return True
+
+
+def save_cached_objects(cache_dir, sourcefile, objects):
+    # only decoded tables are kept; ranks depend on the seed through
+    # class_reseed and each object's signature, so every seed ranks again
+    if not path.exists(cache_dir):
+        makedirs(cache_dir)
+    filename = cache_filename(cache_dir, sourcefile)
+    state = {o.__name__: o.every for o in objects}
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+    replace(filename + '.tmp', filename)
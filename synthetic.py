@@ -0,0 +1,360 @@
+from argparse import ArgumentParser
+from hashlib import md5
+from os import path
+from random import Random
+from shutil import rmtree
+from subprocess import call
+from sys import executable, exit
+from tempfile import mkdtemp
+from romspace import read_validation
+
+
+BASEPATH = path.dirname(path.abspath(__file__))
+TBLPATH = path.join(BASEPATH, 'tables')
+ROM_SIZE = 0x300000
+HEADER_ADDRESS = 0xFFC0
+TEST_LABEL = 'FF6_SYNTHETIC'
+
+# patches that randomizer.py applies on its own, outside of tables_list
+EXTRA_PATCHES = {
+    'tables_list.txt': ['command_shuffle_patch.txt',
+                        'auto_learn_rage_patch.txt',
+                        'let_banon_equip_patch.txt',
+                        'music_player_patch.txt'],
+    'tables_list_bnw2.txt': ['command_shuffle_patch_bnw2.txt',
+                             'let_banon_equip_patch.txt'],
+    }
+
+FIELD_RANGES = {
+    'level': (1, 99),
+    'hp': (10, 9999),
+    'mp': (0, 999),
+    'xp': (0, 9999),
+    'gp': (0, 9999),
+    'price': (1, 9999),
+    'speed': (10, 80),
+    'ai_pointer': (0, 0),
+    'event_addr': (0, 0),
+    }
+
+# values that cleanup and execute_fanatix_mode check for in every record
+TABLE_RANGES = {
+    'CharPaletteObject': {'palette_index': (0, 5)},
+    'EventSpriteObject': {'thirty_seven': (0x37, 0x37),
+                          'forty_three': (0x43, 0x43),
+                          'actor1': (0x10, 0x10),
+                          'actor2': (0x10, 0x10),
+                          'sprite': (0x0E, 0xFE)},
+    'MagiciteObject': {'instruction': (0x86, 0x87),
+                       'esper_index': (0x36, 0x50)},
+    'NpcObject': {'graphics': (0, 0x40)},
+    'ShopObject': {'misc': (1, 5)},
+    }
+
+# values execute_fanatix_mode relies on, by class, index and attribute
+FIXUPS = {
+    'InitialMembitObject': {0x14: {'membyte': 0xFE}},
+    'NatMagCharObject': {0: {'character_index': 0},
+                         1: {'character_index': 6}},
+    # the final battles; vanilla and BNW formations both get a pack
+    'TwoPackObject': dict(
+        (0xF0 + i, {'common': f, 'rare': f}) for (i, f) in enumerate(
+            [0x1d4, 0x1d6, 0x1d5, 0x162, 0x164, 0x163])),
+    }
+
+# where NatMagCharObject checks for the compare instructions of its users
+NATURAL_MAGIC = {'tables_list_jp.txt': 0xa0b7}
+
+
+def read_spec(filename):
+    fields = []
+    with open(path.join(TBLPATH, filename)) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or ',' not in line:
+                continue
+            name, size = line.split(',')[:2]
+            kind = line.split(',')[2] if line.count(',') >= 2 else None
+            if size.startswith('bit'):
+                size = 1
+            elif 'x' in size:
+                length, width = size.split('x')
+                size = int(length) * int(width)
+            else:
+                size = int(size)
+            fields.append((name, size, kind))
+    return fields
+
+
+def read_tables_list(filename):
+    tables, addresses, patches = [], {}, []
+    with open(path.join(TBLPATH, filename)) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            values = line.split()
+            if values[0].startswith('$'):
+                addresses[values[0][1:]] = int(values[1], 0x10)
+            elif values[0] in ['.patch', '.option']:
+                patches.append(values[1])
+            elif values[2].endswith('.txt'):
+                with open(path.join(TBLPATH, values[2])) as g:
+                    pointers = [int(p.split('#')[0], 0x10)
+                                for p in g.read().splitlines()
+                                if p.split('#')[0].strip()]
+                tables.append({'name': values[0], 'spec': values[1],
+                               'pointers': pointers})
+            else:
+                table = {'name': values[0], 'spec': values[1],
+                         'address': int(values[2], 0x10),
+                         'count': int(values[3])}
+                if len(values) > 4 and values[4] == 'pointed':
+                    table['pointed'] = int(values[5], 0x10)
+                    table['pointer_size'] = int(values[6])
+                tables.append(table)
+    return tables, addresses, patches
+
+
+def put(rom, address, data):
+    # anything past the end of the source rom is added by the expansion
+    # patch, so there is nothing to fill in
+    data = data[:max(0, len(rom) - address)]
+    rom[address:address+len(data)] = data
+
+
+def random_value(random, name, size, kind, ranges=FIELD_RANGES):
+    if kind == 'str':
+        length = random.randint(0, size)
+        text = [random.randint(0x80, 0x99) for _ in range(length)]
+        return bytes(text + [0xFF] * (size - length))
+    if kind == 'list':
+        return bytes(random.randint(0, 0x7F) for _ in range(size))
+    if name in ranges:
+        low, high = ranges[name]
+        value = min(random.randint(low, high), (0x100 ** size) - 1)
+    elif size == 1:
+        value = random.randint(0, 0xFE)
+    else:
+        # small enough to be a valid monster, item or formation index
+        value = random.randint(0, 0x17F)
+    return value.to_bytes(size, byteorder='little')
+
+
+def random_record(random, fields, fixups=None, ranges=FIELD_RANGES):
+    data = b''
+    for name, size, kind in fields:
+        if fixups and name in fixups:
+            data += fixups[name].to_bytes(size, byteorder='little')
+        else:
+            data += random_value(random, name, size, kind, ranges)
+    return data
+
+
+def field_offset(fields, name):
+    offset = 0
+    for field, size, _ in fields:
+        if field == name:
+            return offset
+        offset += size
+    raise KeyError(name)
+
+
+def write_pointed(rom, random, table, fields, limit, ranges=FIELD_RANGES):
+    record_size = sum(size for (_, size, _) in fields)
+    count, pointer_size = table['count'], table['pointer_size']
+    base, pointed = table['address'], table['pointed']
+    if base == pointed:
+        start = pointed + ((count+1) * pointer_size)
+        end = limit
+    else:
+        start, end = base, pointed
+    budget = max(0, (end - start) // record_size) if record_size else 0
+    budget = min(budget, count * 2)
+
+    offset = start - base
+    for i in range(count + 1):
+        p = pointed + (i * pointer_size)
+        put(rom, p, offset.to_bytes(pointer_size, byteorder='little'))
+        if i == count:
+            break
+        for _ in range(random.randint(0, min(3, budget))):
+            record = random_record(random, fields, ranges=ranges)
+            put(rom, base+offset, record)
+            offset += record_size
+            budget -= 1
+
+
+def write_tables(rom, random, tables):
+    starts = sorted({t['address'] for t in tables if 'address' in t}
+                    | {t['pointed'] for t in tables if 'pointed' in t})
+    for table in tables:
+        fields = read_spec(table['spec'])
+        record_size = sum(size for (_, size, _) in fields)
+        fixups = FIXUPS.get(table['name'], {})
+        ranges = dict(FIELD_RANGES, **TABLE_RANGES.get(table['name'], {}))
+        if 'pointers' in table:
+            for i, pointer in enumerate(table['pointers']):
+                record = random_record(random, fields, fixups.get(i), ranges)
+                put(rom, pointer, record)
+        elif 'pointed' in table:
+            start = max(table['address'], table['pointed'])
+            limit = min([s for s in starts if s > start] + [len(rom)])
+            write_pointed(rom, random, table, fields, limit, ranges)
+        elif record_size:
+            for i in range(table['count']):
+                record = random_record(random, fields, fixups.get(i), ranges)
+                put(rom, table['address'] + (i * record_size), record)
+
+
+def link_palettes(rom, tables):
+    # shop and battle palettes are checked against the character and npc
+    # palettes they were copied from
+    tables = dict((t['name'], t) for t in tables)
+    chars, shops = tables['CharPaletteObject'], tables['ShopPaletteObject']
+    fields = read_spec(shops['spec'])
+    record_size = sum(size for (_, size, _) in fields)
+    offsets = [field_offset(fields, 'index%s' % i) for i in range(4)]
+    for i in range(shops['count']):
+        address = shops['address'] + (i * record_size)
+        value = (rom[chars['address'] + i] + 2) << 1
+        value |= rom[address + offsets[0]] & 0xF1
+        for offset in offsets:
+            put(rom, address + offset, bytes([value]))
+
+    npcs, battles = tables['NPCPaletteObject'], tables['BattlePaletteObject']
+    record_size = sum(size for (_, size, _) in read_spec(npcs['spec']))
+    for i in range(battles['count']):
+        source = npcs['address'] + ((i if i <= 5 else 8) * record_size)
+        put(rom, battles['address'] + (i * record_size),
+            rom[source:source+record_size])
+
+
+def write_ai_scripts(rom, random, tables, addresses):
+    if 'ai_scripts_address' not in addresses:
+        return
+    [table] = [t for t in tables if t['name'] == 'MonsterAIObject']
+    fields = read_spec(table['spec'])
+    record_size = sum(size for (_, size, _) in fields)
+    base = addresses['ai_scripts_address']
+    offset = 0
+    for i in range(table['count']):
+        script = []
+        for _ in range(random.randint(1, 4)):
+            if random.randint(1, 4) == 4:
+                script += [0xF0] + [random.randint(0, 0xEF)
+                                    for _ in range(3)]
+            else:
+                script.append(random.randint(0, 0xEF))
+        script.append(0xFF)
+        if random.choice([True, False]):
+            script.append(random.randint(0, 0xEF))
+        script.append(0xFF)
+        put(rom, base+offset, bytes(script))
+        put(rom, table['address'] + (i * record_size),
+            offset.to_bytes(2, byteorder='little'))
+        offset += len(script)
+
+
+def write_validation(rom, patches, natural_magic=0xa182):
+    for patch in patches:
+        if not patch.endswith('.txt'):
+            continue
+        for address, data in read_validation(path.join(TBLPATH, patch)):
+            put(rom, address, data)
+    for i, fixup in sorted(FIXUPS['NatMagCharObject'].items()):
+        put(rom, natural_magic + (4 * i),
+            bytes([0xC9, fixup['character_index']]))
+
+
+def write_snes_header(rom, title='FINAL FANTASY 3'):
+    header = title.encode('ascii').ljust(21)
+    header += bytes([0x31, 0x02, 0x0C, 0x03, 0x01, 0x33, 0x00])
+    header += bytes([0xFF, 0xFF, 0x00, 0x00])
+    rom[HEADER_ADDRESS:HEADER_ADDRESS+len(header)] = header
+    # 3MB roms are checksummed as 2MB plus the last 1MB mirrored
+    checksum = sum(rom[:0x200000]) + (sum(rom[0x200000:]) * 2)
+    checksum &= 0xFFFF
+    complement = checksum ^ 0xFFFF
+    rom[HEADER_ADDRESS+0x1C:HEADER_ADDRESS+0x20] = (
+        complement.to_bytes(2, byteorder='little')
+        + checksum.to_bytes(2, byteorder='little'))
+
+
+def generate_rom(tables_list='tables_list.txt', seed=0):
+    random = Random(seed)
+    rom = bytearray(random.randint(0, 0xFF) for _ in range(ROM_SIZE))
+    tables, addresses, patches = read_tables_list(tables_list)
+    write_tables(rom, random, tables)
+    link_palettes(rom, tables)
+    write_ai_scripts(rom, random, tables, addresses)
+    write_validation(rom, patches + EXTRA_PATCHES.get(tables_list, []),
+                     NATURAL_MAGIC.get(tables_list, 0xa182))
+    write_snes_header(rom)
+    return bytes(rom)
+
+
+def smoke_test(sourcefile, flags, seed=1001):
+    # one seed through batch mode, which needs the rom to be registered
+    tempdir = mkdtemp()
+    try:
+        return call([executable, path.join(BASEPATH, 'batch.py'),
+                     sourcefile, str(seed), '--flags', flags,
+                     '--output-dir', tempdir], cwd=BASEPATH) == 0
+    finally:
+        rmtree(tempdir)
+
+
+def register_label(data, tables_list='tables_list.txt', label=TEST_LABEL):
+    filename = path.join(TBLPATH, 'master.txt')
+    rom_hash = md5(data).hexdigest()
+    with open(filename) as f:
+        if rom_hash in f.read():
+            return False
+    with open(filename, 'a') as f:
+        f.write('{0:20}{1}    {2}\n'.format(label, rom_hash, tables_list))
+    return True
+
+
+def unregister_label(data):
+    filename = path.join(TBLPATH, 'master.txt')
+    rom_hash = md5(data).hexdigest()
+    with open(filename) as f:
+        lines = f.readlines()
+    with open(filename, 'w') as f:
+        f.writelines(line for line in lines if rom_hash not in line)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Generate a synthetic FF6 source rom for testing.')
+    parser.add_argument('outfile')
+    parser.add_argument('--tables-list', default='tables_list.txt')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--register', action='store_true',
+                        help='add the rom to tables/master.txt')
+    parser.add_argument('--label', default=TEST_LABEL,
+                        help='label to register the rom under; BNW 2 '
+                             'layouts need "BNW_2" in the label')
+    parser.add_argument('--smoke', nargs='?', const='vfanatix',
+                        help='generate one seed from the rom with batch.py, '
+                             'with these flags')
+    args = parser.parse_args()
+
+    data = generate_rom(args.tables_list, args.seed)
+    with open(args.outfile, 'wb') as f:
+        f.write(data)
+    registered = False
+    if args.register or args.smoke:
+        registered = register_label(data, args.tables_list, args.label)
+    print('%s %s' % (args.outfile, md5(data).hexdigest()))
+    if args.smoke:
+        try:
+            passed = smoke_test(args.outfile, args.smoke)
+        finally:
+            # only --register leaves the rom in master.txt
+            if registered and not args.register:
+                unregister_label(data)
+        if not passed:
+            print('Smoke test failed with flags %s.' % args.smoke)
+            exit(1)
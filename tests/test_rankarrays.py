@@ -0,0 +1,132 @@
+from collections import defaultdict
+from random import Random
+import rankarrays
+import unittest
+
+
+WEIGHTS = {4: [5, 5, 5, 1], 2: [1, 1]}
+
+
+# the python versions of each rank, as in randomizer.py
+def monster_base_ranks(positions_a, positions_b, formations):
+    base = []
+    for a, b in zip(positions_a, positions_b):
+        if a < 0:
+            base.append(-1)
+            continue
+        a, b = a * 1.5, b * 1
+        base.append(max(a, b) * (a + b))
+    companions = defaultdict(set)
+    for formation in formations:
+        enemies = {i for i in formation if base[i] >= 0}
+        for i in enemies:
+            companions[i] |= enemies
+    return base, companions
+
+
+def monster_ranks(base, companions, fixed):
+    ranks = []
+    for i, rank in enumerate(base):
+        if i not in companions:
+            ranks.append(-1)
+            continue
+        companion_rank = (sum([base[j] for j in companions[i]])
+                          / len(companions[i]))
+        similarity = rank / companion_rank
+        if similarity > 1:
+            similarity = 1 / similarity
+        ratio = similarity / 2
+        if fixed[i]:
+            ranks.append(rank)
+        else:
+            ranks.append((rank * (1 - ratio)) + (companion_rank * ratio))
+    return ranks
+
+
+def formation_rank(enemy_ranks):
+    if not enemy_ranks:
+        return -1
+    return max(enemy_ranks) * (sum(enemy_ranks) ** 0.0625)
+
+
+def pack_rank(formation_ranks):
+    if any(rank < 0 for rank in formation_ranks):
+        return -1
+    weights = WEIGHTS[len(formation_ranks)]
+    rank = 0
+    for weight, formation in zip(weights, formation_ranks):
+        rank += (weight / float(sum(weights))) * formation
+    return rank
+
+
+class TestRankArrays(unittest.TestCase):
+    # results are compared by repr, so they must match to the last bit
+    # and keep the int -1 for unranked rows
+    def setUp(self):
+        rankarrays.use_numpy()
+        if not rankarrays.USE_NUMPY:
+            self.skipTest('numpy is not installed')
+        self.random = Random(0)
+
+    def tearDown(self):
+        rankarrays.use_numpy(False)
+
+    def test_monster_ranks(self):
+        random = self.random
+        for _ in range(50):
+            count = random.randint(5, 300)
+            eligible = [i for i in range(count) if random.random() < 0.85]
+            order_a, order_b = list(eligible), list(eligible)
+            random.shuffle(order_a)
+            random.shuffle(order_b)
+            positions_a = [order_a.index(i) if i in eligible else -1
+                           for i in range(count)]
+            positions_b = [order_b.index(i) if i in eligible else -1
+                           for i in range(count)]
+            fixed = [random.random() < 0.2 for _ in range(count)]
+            formations = [[random.randrange(count)
+                           for _ in range(random.randint(1, 6))]
+                          for _ in range(count)]
+            base, companions = monster_base_ranks(
+                positions_a, positions_b, formations)
+            array_base = rankarrays.monster_base_ranks(
+                positions_a, positions_b, 1.5, 1)
+            self.assertEqual(repr(array_base), repr(base))
+
+            # companions in the order the python version adds them up
+            rows = [list(companions[i]) if i in companions else []
+                    for i in range(count)]
+            fixed = [i in companions and fixed[i] for i in range(count)]
+            try:
+                ranks = monster_ranks(base, companions, fixed)
+            except ZeroDivisionError:
+                with self.assertRaises(ZeroDivisionError):
+                    rankarrays.companion_ranks(array_base, rows, fixed=fixed,
+                                               default=-1)
+                continue
+            array_ranks = rankarrays.companion_ranks(
+                array_base, rows, fixed=fixed, default=-1)
+            self.assertEqual(repr(array_ranks), repr(ranks))
+
+    def test_formation_ranks(self):
+        random = self.random
+        enemy_ranks = [[random.random() * 1e6
+                        for _ in range(random.randint(0, 6))]
+                       for _ in range(500)]
+        self.assertEqual(
+            repr(rankarrays.formation_base_ranks(enemy_ranks)),
+            repr([formation_rank(ranks) for ranks in enemy_ranks]))
+
+    def test_pack_ranks(self):
+        random = self.random
+        packs = [[random.choice([-1] + [random.random() * 1e5] * 9)
+                  for _ in range(random.choice([2, 4]))]
+                 for _ in range(500)]
+        self.assertEqual(
+            repr(rankarrays.pack_ranks(
+                packs, [WEIGHTS[len(pack)] for pack in packs])),
+            repr([pack_rank(pack) for pack in packs]))
+
+
+if __name__ == '__main__':
+    unittest.main()
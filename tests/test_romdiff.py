@@ -0,0 +1,182 @@
+from romdiff import (
+    IPS_EOF, IPS_MAX_RECORD, bps_number, diff_runs, make_bps, make_ips,
+    make_patch)
+from zlib import crc32
+import unittest
+
+
+def apply_ips(source, patch):
+    assert patch[:5] == b'PATCH'
+    data = bytearray(source)
+    pointer = 5
+    while patch[pointer:pointer+3] != b'EOF':
+        address = int.from_bytes(patch[pointer:pointer+3], byteorder='big')
+        length = int.from_bytes(patch[pointer+3:pointer+5], byteorder='big')
+        pointer += 5
+        if length == 0:
+            length = int.from_bytes(patch[pointer:pointer+2],
+                                    byteorder='big')
+            data[address:address+length] = patch[pointer+2:pointer+3] * length
+            pointer += 3
+        else:
+            data[address:address+length] = patch[pointer:pointer+length]
+            pointer += length
+    assert pointer + 3 == len(patch)
+    return bytes(data)
+
+
+def read_bps_number(patch, pointer):
+    value, shift = 0, 1
+    while True:
+        byte = patch[pointer]
+        pointer += 1
+        value += (byte & 0x7F) * shift
+        if byte & 0x80:
+            return value, pointer
+        shift <<= 7
+        value += shift
+
+
+def apply_bps(source, patch):
+    assert patch[:4] == b'BPS1'
+    assert crc32(patch[:-4]) == int.from_bytes(patch[-4:], 'little')
+    source_size, pointer = read_bps_number(patch, 4)
+    target_size, pointer = read_bps_number(patch, pointer)
+    metadata_size, pointer = read_bps_number(patch, pointer)
+    assert source_size == len(source)
+    pointer += metadata_size
+    target = bytearray()
+    source_relative = target_relative = 0
+    while pointer < len(patch) - 12:
+        value, pointer = read_bps_number(patch, pointer)
+        command, length = value & 3, (value >> 2) + 1
+        if command == 0:
+            target += source[len(target):len(target)+length]
+        elif command == 1:
+            target += patch[pointer:pointer+length]
+            pointer += length
+        else:
+            offset, pointer = read_bps_number(patch, pointer)
+            offset = -(offset >> 1) if offset & 1 else offset >> 1
+            if command == 2:
+                source_relative += offset
+                target += source[source_relative:source_relative+length]
+                source_relative += length
+            else:
+                target_relative += offset
+                for _ in range(length):
+                    target.append(target[target_relative])
+                    target_relative += 1
+    assert len(target) == target_size
+    assert crc32(target) == int.from_bytes(patch[-8:-4], 'little')
+    return bytes(target)
+
+
+def changed(source, changes):
+    data = bytearray(source)
+    for address, values in changes:
+        data[address:address+len(values)] = values
+    return bytes(data)
+
+
+class TestDiffRuns(unittest.TestCase):
+    def test_runs(self):
+        source = bytes(0x3000)
+        target = changed(source, [(0x10, b'\x01\x02'), (0x14, b'\x03'),
+                                  (0x1FFF, b'\x04\x05'), (0x2800, b'\x06')])
+        self.assertEqual(diff_runs(source, target),
+                         [(0x10, 0x15), (0x1FFF, 0x2001), (0x2800, 0x2801)])
+        self.assertEqual(diff_runs(source, target, 0),
+                         [(0x10, 0x12), (0x14, 0x15), (0x1FFF, 0x2001),
+                          (0x2800, 0x2801)])
+
+    def test_longer_target(self):
+        source = bytes(0x100)
+        target = changed(source, [(0x80, b'\x01')]) + b'\x02' * 0x10
+        self.assertEqual(diff_runs(source, target),
+                         [(0x80, 0x81), (0x100, 0x110)])
+
+
+class TestIPS(unittest.TestCase):
+    def test_round_trip(self):
+        source = bytes(range(0x100)) * 0x100
+        target = changed(source, [(0, b'\xff'), (0x1234, b'abcdef'),
+                                  (len(source)-1, b'\x00')])
+        patch = make_ips(source, target)
+        self.assertEqual(apply_ips(source, patch), target)
+
+    def test_unchanged(self):
+        source = bytes(0x1000)
+        self.assertEqual(make_ips(source, source), b'PATCHEOF')
+
+    def test_long_run(self):
+        source = bytes(0x30000)
+        target = changed(source, [(0x100, b'\x01' * (IPS_MAX_RECORD + 10))])
+        patch = make_ips(source, target)
+        self.assertEqual(apply_ips(source, patch), target)
+
+    def test_eof_address(self):
+        # a record at 0x454F46 would read as the end of the patch, so it
+        # starts a byte early
+        source = bytes(IPS_EOF + 0x10)
+        target = changed(source, [(IPS_EOF, b'\x01\x02')])
+        patch = make_ips(source, target)
+        self.assertEqual(patch[5:8], (IPS_EOF-1).to_bytes(3, 'big'))
+        self.assertEqual(apply_ips(source, patch), target)
+
+    def test_eof_address_after_split(self):
+        # a long run whose second record would start at 0x454F46
+        source = bytes(IPS_EOF + 0x10)
+        start = IPS_EOF - IPS_MAX_RECORD
+        target = changed(source, [(start, b'\x01' * (IPS_MAX_RECORD + 4))])
+        patch = make_ips(source, target)
+        # apply_ips fails on anything after an early end marker
+        self.assertEqual(apply_ips(source, patch), target)
+
+    def test_size_change(self):
+        with self.assertRaises(Exception):
+            make_ips(bytes(0x10), bytes(0x20))
+
+
+class TestBPS(unittest.TestCase):
+    def test_numbers(self):
+        for value in [0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 0x123456]:
+            data = bytes(bps_number(value))
+            self.assertEqual(read_bps_number(data, 0), (value, len(data)))
+
+    def test_round_trip(self):
+        source = bytes(range(0x100)) * 0x40
+        target = changed(source, [(3, b'xyz'), (0x2000, b'\x00' * 7),
+                                  (len(source)-2, b'\x01\x02')])
+        self.assertEqual(apply_bps(source, make_bps(source, target)), target)
+
+    def test_rle(self):
+        # long runs of one value are a literal byte copied over itself
+        source = bytes(range(0x100)) * 0x40
+        target = changed(source, [(0x100, b'\xaa' * 0x800),
+                                  (0x1000, b'abc' + b'\xbb' * 0x40 + b'de')])
+        patch = make_bps(source, target)
+        self.assertLess(len(patch), 0x80)
+        self.assertEqual(apply_bps(source, patch), target)
+
+    def test_short_runs(self):
+        source = bytes(0x400)
+        target = changed(source, [(0x10, b'\x01\x01\x02\x02\x02\x03' * 8)])
+        self.assertEqual(apply_bps(source, make_bps(source, target)), target)
+
+    def test_expansion(self):
+        source = bytes(range(0x100)) * 0x10
+        target = changed(source, [(0x20, b'\x01')]) + b'\xcc' * 0x1000
+        self.assertEqual(apply_bps(source, make_bps(source, target)), target)
+
+
+class TestMakePatch(unittest.TestCase):
+    def test_format(self):
+        source = bytes(0x100)
+        target = changed(source, [(0x10, b'\x01')])
+        self.assertEqual(make_patch(source, target)[0], 'ips')
+        self.assertEqual(make_patch(source, target + b'\x00')[0], 'bps')
+
+
+if __name__ == '__main__':
+    unittest.main()
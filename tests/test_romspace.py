@@ -0,0 +1,143 @@
+from romspace import IntervalIndex, RomSpace, patch_ranges, read_validation
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+
+PATCH = """
+.def jump_addr      80 78 f0
+
+035524: 20 74 55
+035527: 5c jump_addr        # follows on from the line above
+0358e8:
+: c9 20
+: f0 skip                    # a branch to a name that is not defined
+: a9 01
+: 60
+
+040000: ea
+
+VALIDATION
+
+035524: ad 00 02
+0358e8: c9 20
+: f0 label
+"""
+
+
+class TestIntervalIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = IntervalIndex()
+        for start, end, owner in [(0x100, 0x200, 'a'), (0x120, 0x140, 'b'),
+                                  (0x300, 0x310, 'c'), (0x10, 0x20, 'd')]:
+            self.index.add(start, end, owner)
+
+    def test_sorted(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual([owner for (_, _, owner) in self.index.intervals],
+                         ['d', 'a', 'b', 'c'])
+
+    def test_is_free(self):
+        self.assertTrue(self.index.is_free(0, 0x10))
+        self.assertTrue(self.index.is_free(0x200, 0x300))
+        self.assertTrue(self.index.is_free(0x310, 0x1000))
+        self.assertFalse(self.index.is_free(0x1F, 0x21))
+        self.assertFalse(self.index.is_free(0x150, 0x160))
+        self.assertFalse(self.index.is_free(0x1FF, 0x301))
+
+    def test_overlapping(self):
+        # inside 'a' but after 'b', which starts later and ends sooner
+        self.assertEqual(self.index.overlapping(0x150, 0x160),
+                         [(0x100, 0x200, 'a')])
+        self.assertEqual(self.index.overlapping(0x130, 0x301),
+                         [(0x100, 0x200, 'a'), (0x120, 0x140, 'b'),
+                          (0x300, 0x310, 'c')])
+        self.assertEqual(self.index.overlapping(0x200, 0x300), [])
+
+    def test_add_after_query(self):
+        self.assertTrue(self.index.is_free(0x250, 0x260))
+        self.index.add(0x240, 0x280, 'e')
+        self.assertFalse(self.index.is_free(0x250, 0x260))
+
+
+class TestPatchRanges(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.filename = path.join(self.tempdir, 'test_patch.txt')
+        with open(self.filename, 'w') as f:
+            f.write(PATCH)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_patch_ranges(self):
+        # .def names count for their bytes and other names for one byte
+        self.assertEqual(patch_ranges(self.filename),
+                         [(0x35524, 0x3552B), (0x358e8, 0x358ef),
+                          (0x40000, 0x40001)])
+
+    def test_read_validation(self):
+        # lines with labels cannot be checked
+        self.assertEqual(read_validation(self.filename),
+                         [(0x35524, b'\xad\x00\x02'),
+                          (0x358e8, b'\xc9\x20')])
+
+    def test_no_validation(self):
+        with open(self.filename, 'w') as f:
+            f.write(PATCH.split('VALIDATION')[0])
+        self.assertEqual(read_validation(self.filename), [])
+
+
+class TestRomSpace(unittest.TestCase):
+    def setUp(self):
+        self.space = RomSpace()
+        self.space.reserve(0x1000, 0x1100, 'fanatix')
+        self.space.reserve(0x2000, 0x2400, 'fanatix')
+        self.space.reserve(0x2100, 0x2180, 'patch.txt')
+
+    def test_owners(self):
+        self.assertEqual(self.space.owners(0x20F0, 0x2110),
+                         {'fanatix', 'patch.txt'})
+        self.assertTrue(self.space.is_free(0x1100, 0x2000))
+
+    def test_free_space(self):
+        self.assertEqual(self.space.free_space('fanatix'),
+                         [(0x1000, 0x1100), (0x2000, 0x2100),
+                          (0x2180, 0x2400)])
+
+    def test_best_fit(self):
+        # the smallest block each one fits in, so the largest stays whole
+        self.assertEqual(self.space.allocate(0xF0, 'fanatix'), 0x1000)
+        self.assertEqual(self.space.allocate(0x80, 'fanatix'), 0x2000)
+        self.assertEqual(self.space.allocate(0x20, 'fanatix'), 0x2080)
+        self.assertEqual(self.space.free_space('fanatix'),
+                         [(0x10F0, 0x1100), (0x20A0, 0x2100),
+                          (0x2180, 0x2400)])
+        self.assertEqual(self.space.allocate(0x200, 'fanatix'), 0x2180)
+
+    def test_not_enough_space(self):
+        self.space.allocate(0x280, 'fanatix')
+        with self.assertRaises(Exception):
+            self.space.allocate(0x101, 'fanatix')
+
+    def test_report(self):
+        self.space.allocate(0x100, 'fanatix')
+        report = self.space.report()['fanatix']
+        self.assertEqual(report['regions'], 2)
+        self.assertEqual(report['used'], 0x100)
+        self.assertEqual(report['free_blocks'], 2)
+        self.assertEqual(report['largest_free'], 0x280)
+
+    def test_use_outside(self):
+        with self.assertRaises(Exception):
+            self.space.use(0x10F0, 0x1110, 'fanatix')
+        with self.assertRaises(Exception):
+            self.space.use(0x2150, 0x2160, 'fanatix')
+        self.space.use(0x1000, 0x1010, 'fanatix')
+        with self.assertRaises(Exception):
+            self.space.use(0x1008, 0x1018, 'fanatix')
+
+
+if __name__ == '__main__':
+    unittest.main()